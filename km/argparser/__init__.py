@@ -2,5 +2,8 @@ __all__ = [
     'common',
     'find_mutation',
     'find_report',
-    'linear_kmin'
+    'linear_kmin',
+    'serve',
+    'convert',
+    'extract'
 ]
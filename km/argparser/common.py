@@ -1,4 +1,5 @@
 import os
+import argparse
 
 
 def is_valid_path(parser, p_file):
@@ -14,3 +15,13 @@ def is_valid_file(parser, n_file):
         parser.error("The file %s does not exist!" % n_file)
     else:
         return n_file
+
+
+def sweep_setting(value):
+    """Parse a ratio:count:steps:branchs parameter set."""
+    try:
+        (ratio, count, steps, branchs) = value.split(":")
+        return (float(ratio), int(count), int(steps), int(branchs))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%s is not a ratio:count:steps:branchs setting" % value)
@@ -0,0 +1,20 @@
+import sys
+import argparse
+from .common import *
+
+
+def get_argparser_convert(parser):
+    parser.add_argument(
+        "-o",
+        dest="output",
+        help="Filename of the k-mer array database to write",
+        required=True,
+        type=str)
+
+    parser.add_argument(
+        'infile',
+        help="Output of jellyfish dump, fasta or column (-c) format " +
+             "(Default: stdin)",
+        nargs='?',
+        type=argparse.FileType('r'),
+        default=sys.stdin)
@@ -0,0 +1,42 @@
+from .common import *
+
+
+def get_argparser_extract(parser):
+    parser.add_argument(
+        "-c", "--count",
+        help="Minimum occurence needed for exploration of alternative (default: -c 5)",
+        action="store",
+        nargs='?',
+        default=5,
+        type=int)
+    parser.add_argument(
+        "-p", "--ratio",
+        help="Minimum occurence ratio needed for exploration of alternative (default: -p 0.05)",
+        action="store",
+        nargs='?',
+        default=0.05,
+        type=float)
+    parser.add_argument(
+        "-s", "--steps",
+        help="Maximum steps to discover a new branch on a target sequence (default: -s 500)",
+        action="store",
+        nargs='?',
+        default=500,
+        type=int)
+    parser.add_argument(
+        "-o",
+        dest="output",
+        help="Filename of the k-mer array database to write",
+        required=True,
+        type=str)
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Get more information.",
+        action="store_true")
+    parser.add_argument(
+        "target_fn",
+        help="Filename of the target sequence file or directory.",
+        nargs='*')
+    parser.add_argument(
+        "jellyfish_fn",
+        help="Filename of the jellyfish database.")
@@ -30,6 +30,42 @@ def get_argparser_find_mut(parser):
         nargs='?',
         default=10,
         type=int)
+    parser.add_argument(
+        "-t", "--threads",
+        help="Number of targets processed in parallel (default: -t 1)",
+        action="store",
+        default=1,
+        type=int)
+    parser.add_argument(
+        "-l", "--db-list",
+        help="jellyfish_fn is a text file listing one database per line, all analysed in one run.",
+        action="store_true")
+    parser.add_argument(
+        "--cache-size",
+        help="Maximum number of k-mer counts kept in memory, 0 to disable (default: --cache-size 1000000)",
+        action="store",
+        default=1000000,
+        type=int)
+    parser.add_argument(
+        "--compact",
+        help="Collapse non-branching chains of k-mers before searching paths. Among variant paths " +
+             "of equal cost, another one than without --compact may be reported.",
+        action="store_true")
+    parser.add_argument(
+        "--solver",
+        help="Method giving the non-negative path coefficients: gradient descent, or exact " +
+             "non-negative least squares, which may split the expression differently among paths " +
+             "sharing their k-mers. Only nnls solves the fits against the reference of all the " +
+             "paths of a target in one batch (default: --solver gradient)",
+        choices=["nnls", "gradient"],
+        default="gradient")
+    parser.add_argument(
+        "--sweep",
+        help="Run with each ratio:count:steps:branchs setting (e.g. --sweep 0.05:5:500:10 --sweep 0.1:10:500:5), " +
+             "sharing one walk at the most permissive one. -p, -c, -s and -b are then ignored.",
+        action="append",
+        metavar="RATIO:COUNT:STEPS:BRANCHS",
+        type=sweep_setting)
     parser.add_argument(
         "-g", "--graphical",
         help="Display coverage graph.",
@@ -44,4 +80,4 @@ def get_argparser_find_mut(parser):
         nargs='*')
     parser.add_argument(
         "jellyfish_fn",
-        help="Filename of the jellyfish database.")
+        help="Filename of the jellyfish database (or list of databases with -l).")
@@ -0,0 +1,27 @@
+from .common import *
+
+
+def get_argparser_serve(parser):
+    parser.add_argument(
+        "-s", "--socket",
+        help="Path of the unix socket to listen on (default: -s km.sock)",
+        action="store",
+        default="km.sock",
+        type=str)
+    parser.add_argument(
+        "-m", "--max-open",
+        help="Maximum number of databases kept open (default: -m 8)",
+        action="store",
+        default=8,
+        type=int)
+    parser.add_argument(
+        "--cache-size",
+        help="Maximum number of k-mer counts kept in memory for each database, 0 to disable " +
+             "(default: --cache-size 1000000)",
+        action="store",
+        default=1000000,
+        type=int)
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Get more information.",
+        action="store_true")
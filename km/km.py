@@ -4,11 +4,17 @@ from .argparser.find_mutation import *
 from .argparser.find_report import *
 from .argparser.linear_kmin import *
 from .argparser.min_cov import *
+from .argparser.serve import *
+from .argparser.convert import *
+from .argparser.extract import *
 
 from .tools.find_mutation import main_find_mut
 from .tools.find_report import main_find_report
 from .tools.linear_kmin import main_linear_kmin
 from .tools.min_cov import main_min_cov
+from .tools.serve import main_serve
+from .tools.convert import main_convert
+from .tools.extract import main_extract
 
 
 # ###########################################################################
@@ -54,6 +60,30 @@ def main():
     min_cov.set_defaults(func=main_min_cov)
     get_argparser_min_cov(min_cov)
 
+    # create the argparser for the "serve" command
+    serve = subparsers.add_parser(
+        'serve',
+        help='Keep databases open and run find_mutation and min_cov jobs sent on a unix socket.'
+    )
+    serve.set_defaults(func=main_serve)
+    get_argparser_serve(serve)
+
+    # create the argparser for the "convert" command
+    convert = subparsers.add_parser(
+        'convert',
+        help='Convert a jellyfish dump in a k-mer array database, usable without the jellyfish bindings.'
+    )
+    convert.set_defaults(func=main_convert)
+    get_argparser_convert(convert)
+
+    # create the argparser for the "extract" command
+    extract = subparsers.add_parser(
+        'extract',
+        help='Extract the k-mers find_mutation needs around target sequences in a small k-mer array database.'
+    )
+    extract.set_defaults(func=main_extract)
+    get_argparser_extract(extract)
+
     # recover arguments
     args = argparser.parse_args()
 
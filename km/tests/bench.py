@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Micro-benchmark of uncached k-mer count queries.
+#
+#   Usage:  python -m km.tests.bench <jellyfish_db> [target_fasta]
+#
+# Times Jellyfish.query, get_child and get_child_codes (used by the
+# MutationFinder walk) with the count cache disabled, so that every k-mer
+# is a miss. With the jellyfish bindings, the same queries done directly on
+# the bindings (one canonicalized MerDNA per k-mer) are timed as a
+# reference.
+
+import sys
+import random
+import timeit
+
+from km.utils import common as uc
+from km.utils import Kmer
+from km.utils.Jellyfish import Jellyfish, JellyfishDB
+
+
+def time_per_kmer(f, kmers, kmers_per_call=1, repeat=5):
+    best = min(timeit.repeat(lambda: [f(s) for s in kmers],
+                             number=1, repeat=repeat))
+    return 1e6 * best / (len(kmers) * kmers_per_call)
+
+
+def direct_query(db):
+    def query(seq):
+        kmer = db.mer(seq)
+        kmer.canonicalize()
+        return db.jf[kmer]
+    return query
+
+
+def direct_get_child(db, jf):
+    query = direct_query(db)
+
+    def get_child(seq):
+        child = []
+        total = 0
+        for c in "ACGT":
+            c_seq = seq[1:] + c
+            c_count = query(c_seq)
+            child.append((c_seq, c_count))
+            total += c_count
+        threshold = max(total * jf.cutoff, jf.n_cutoff)
+        return [s for (s, n) in child if n >= threshold]
+    return get_child
+
+
+def main(argv):
+    jf = Jellyfish(argv[1], cache_size=0)
+    if len(argv) > 2:
+        ref_seq = uc.file_2_seq(argv[2])
+        kmers = [ref_seq[i:(i + jf.k)]
+                 for i in range(len(ref_seq) - jf.k + 1)]
+    else:
+        rand = random.Random(0)
+        kmers = ["".join(rand.choice("ACGT") for i in range(jf.k))
+                 for j in range(2000)]
+
+    print("%d %d-mers, us per k-mer:" % (len(kmers), jf.k))
+    print("query\t%.2f" % time_per_kmer(jf.query, kmers))
+    print("get_child\t%.2f" % time_per_kmer(jf.get_child, kmers, 4))
+    print("get_child_codes\t%.2f" % time_per_kmer(
+        jf.get_child_codes, Kmer.encode_many(kmers, jf.k).tolist(), 4))
+    if isinstance(jf.db, JellyfishDB):
+        print("bindings query\t%.2f" % time_per_kmer(direct_query(jf.db),
+                                                     kmers))
+        print("bindings get_child\t%.2f" % time_per_kmer(
+            direct_get_child(jf.db, jf), kmers, 4))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -6,19 +6,31 @@ import unittest
 
 import os
 import sys
+import json
+import asyncio
+import tempfile
 
 from argparse import Namespace
 from km.tools import find_mutation as fm
 from km.tools import find_report as fr
 from km.tools import linear_kmin as lk
+from km.tools import min_cov as mc
+from km.tools import serve
+from km.tools import extract
 
-from km.utils.Jellyfish import Jellyfish
+from km.utils.Jellyfish import Jellyfish, CountDict
 from km.utils import MutationFinder as umf
+from km.utils import Graph as ug
+from km.utils import PathQuant as upq
 from km.utils import common as uc
+from km.utils import Kmer
+from km.utils.KmerArray import KmerArray, read_dump
 
 from contextlib import contextmanager
 from io import StringIO
 
+import numpy as np
+
 
 @contextmanager
 def captured_output():
@@ -477,6 +489,257 @@ class kmMuttaionTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             uc.get_ref_kmer(ref_seq, k_len, ref_name)
 
+    def test_compact_paths(self):
+        # Reference 0 -> 7, a bubble 2 -> 8 -> 9 -> 10 -> 5 and a deletion
+        graph = ug.Graph(11)
+        for i in range(7):
+            graph[i, i + 1] = 0.01
+        for (i, j) in [(2, 8), (8, 9), (9, 10), (10, 5), (1, 4)]:
+            graph[i, j] = 1
+
+        unitig_graph = graph.compact(protected=[0, 7])
+        self.assertLess(unitig_graph.n, graph.n)
+
+        graph.init_paths(0, 7)
+        unitig_graph.init_paths(unitig_graph.unitig_of[0],
+                                unitig_graph.unitig_of[7])
+        self.assertEqual(
+            sorted(graph.all_shortest()),
+            sorted(unitig_graph.expand(p) for p in unitig_graph.all_shortest()))
+
+    def test_sparse_graph(self):
+        # Reference 0 -> 9, a bubble, a deletion and a duplication (back
+        # edge), along with edges out of the reference paths
+        edges = [(2, 10), (10, 11), (11, 5), (1, 4), (6, 12), (12, 3),
+                 (7, 13), (13, 14), (14, 8), (10, 13)]
+        graphs = []
+        for sparse in (True, False):
+            graph = ug.Graph(15, sparse=sparse)
+            for i in range(9):
+                graph[i, i + 1] = 0.01
+            for (i, j) in edges:
+                graph[i, j] = 1
+            graph.init_paths(0, 9)
+            graphs.append(graph)
+        (sparse_graph, dense_graph) = graphs
+        self.assertTrue(sparse_graph.sparse)
+        self.assertFalse(dense_graph.sparse)
+
+        for i in range(15):
+            for j in range(15):
+                self.assertEqual(sparse_graph[i, j], dense_graph[i, j])
+        self.assertEqual(sparse_graph.before.tolist(),
+                         dense_graph.before.tolist())
+        self.assertEqual(sparse_graph.after.tolist(),
+                         dense_graph.after.tolist())
+        self.assertEqual(sparse_graph.all_shortest(),
+                         dense_graph.all_shortest())
+        self.assertEqual(sparse_graph.all_shortest(one_pass=False),
+                         dense_graph.all_shortest(one_pass=False))
+
+    def test_kmer_encoding(self):
+        seq = "GATTACAGATTACAGATTACAGATTACAGAT"
+        k_len = len(seq)
+        code = Kmer.encode(seq)
+
+        self.assertEqual(Kmer.decode(code, k_len), seq)
+        self.assertEqual(Kmer.decode(Kmer.revcomp(code, k_len), k_len),
+                         "ATCTGTAATCTGTAATCTGTAATCTGTAATC")
+        self.assertEqual(
+            [Kmer.decode(c, k_len) for c in Kmer.children(code, k_len)],
+            [seq[1:] + c for c in "ACGT"])
+        self.assertEqual(
+            [Kmer.decode(c, k_len) for c in Kmer.children(code, k_len, False)],
+            [c + seq[:-1] for c in "ACGT"])
+
+        # Batches above and below Kmer.SMALL_BATCH, odd and even k
+        for k_len in (k_len, 4):
+            kmers = [seq[i:(i + k_len)] for i in range(len(seq) - k_len + 1)]
+            kmers = kmers * (2 * Kmer.SMALL_BATCH // len(kmers) + 1)
+            codes = Kmer.encode_many(kmers, k_len).tolist()
+            self.assertEqual(codes, [Kmer.encode(s) for s in kmers])
+            self.assertEqual(Kmer.decode_many(codes, k_len), kmers)
+            self.assertEqual(Kmer.decode_many(codes[:3], k_len), kmers[:3])
+
+        with self.assertRaises(ValueError):
+            Kmer.encode("GATTNCA")
+
+    def test_long_kmers(self):
+        # k > Kmer.MAX_K: codes don't fit in 64 bits
+        ref_seq = kmSampleTest.ref_a
+        alt_seq = ref_seq[:45] + "A" + ref_seq[46:]
+        k_len = 41
+        kmers = [ref_seq[i:(i + k_len)] for i in range(len(ref_seq) - k_len + 1)]
+        kmers = kmers * (Kmer.SMALL_BATCH // len(kmers) + 1)
+        revcomps = [s[::-1].translate(str.maketrans("ACGT", "TGCA"))
+                    for s in kmers]
+
+        codes = Kmer.encode_many(kmers, k_len).tolist()
+        self.assertEqual(codes, [Kmer.encode(s) for s in kmers])
+        self.assertEqual(Kmer.decode_many(codes, k_len), kmers)
+        self.assertEqual(
+            Kmer.canonical_many(codes, k_len).tolist(),
+            [min(c, Kmer.encode(r)) for (c, r) in zip(codes, revcomps)])
+        self.assertEqual(
+            [Kmer.decode(c, k_len) for c in Kmer.children(codes[0], k_len)],
+            [kmers[0][1:] + c for c in "ACGT"])
+
+        counts = {}
+        for (seq, count) in [(ref_seq, 100), (alt_seq, 30)]:
+            for i in range(len(seq) - k_len + 1):
+                code = Kmer.canonical(Kmer.encode(seq[i:(i + k_len)]), k_len)
+                counts[code] = counts.get(code, 0) + count
+        jf = Jellyfish("long_kmers", cutoff=0.05, n_cutoff=5,
+                       backend=CountDict(k_len, counts))
+        self.assertEqual(jf.query_many(revcomps).tolist(),
+                         [counts[Kmer.canonical(c, k_len)] for c in codes])
+
+        finder = umf.MutationFinder("long_kmers", ref_seq, jf, False)
+        variants = [(p.variant_type, p.variant_name)
+                    for p in finder.get_paths()]
+        self.assertIn(("Substitution", "46:c/A:47"), variants)
+
+    def test_kmer_array(self):
+        dump = StringIO(">7\nACGTA\n>3\nCCCCC\nGATTA 12\n")
+        kmers = read_dump(dump)
+        self.assertEqual((kmers.k, len(kmers)), (5, 3))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            kmers_fn = os.path.join(tmp_dir, "kmers.kma")
+            kmers.save(kmers_fn)
+
+            jf = Jellyfish(kmers_fn, cutoff=0.1, n_cutoff=1)
+            self.assertEqual(jf.k, 5)
+            self.assertEqual(
+                jf.query_many(["ACGTA", "TACGT", "GGGGG", "GATTA", "AAAAA"]).tolist(),
+                [7, 7, 3, 12, 0])
+            self.assertEqual(jf.get_child("CGATT"), ["GATTA"])
+
+    def test_count_cache(self):
+        kmers = read_dump(StringIO("ACGTA 7\nCCCCC 3\nGATTA 12\n"))
+        queried = []
+
+        class CountingDB:
+            k = kmers.k
+
+            def count_many(self, codes):
+                queried.extend(codes)
+                return kmers.count_many(codes)
+
+        def code(seq):
+            return Kmer.canonical(Kmer.encode(seq), kmers.k)
+
+        jf = Jellyfish("kmers", cache_size=2, backend=CountingDB())
+        self.assertEqual(jf.query_many(["ACGTA", "CCCCC", "TACGT"]).tolist(),
+                         [7, 3, 7])
+        self.assertEqual((jf.hits, jf.misses, len(queried)), (0, 2, 2))
+
+        # The least recently used count is dropped
+        self.assertEqual(jf.query("ACGTA"), 7)
+        self.assertEqual(jf.query("GATTA"), 12)
+        self.assertEqual(list(jf.cache), [code("ACGTA"), code("GATTA")])
+        self.assertEqual(jf.query("CCCCC"), 3)
+        self.assertEqual((jf.hits, jf.misses, len(queried)), (1, 4, 4))
+
+        # Without cache, only the distinct k-mers of a batch are queried once
+        del queried[:]
+        jf = Jellyfish("kmers", cache_size=0, backend=CountingDB())
+        self.assertEqual(jf.query_many(["ACGTA", "TACGT", "GATTA"]).tolist(),
+                         [7, 7, 12])
+        self.assertEqual(jf.query("ACGTA"), 7)
+        self.assertEqual((jf.hits, jf.misses, len(queried)), (0, 3, 3))
+        self.assertEqual(len(jf.cache), 0)
+
+    def test_nnls(self):
+        rand = np.random.RandomState(0)
+        for i in range(20):
+            a = rand.randint(0, 3, size=(12, 5)).astype(float)
+            b = rand.normal(10, 10, size=12)
+            (x, num_iter) = upq.nnls(a, b)
+
+            # Karush-Kuhn-Tucker conditions
+            w = a.T.dot(b - a.dot(x))
+            self.assertTrue((x >= 0).all())
+            self.assertTrue((w < 1e-6).all())
+            self.assertTrue((np.abs(w[x > 0]) < 1e-6).all())
+
+        # A duplicated column gives the fit of the distinct columns
+        a = np.array([[1, 1, 0], [1, 1, 1], [0, 0, 1], [1, 1, 0]], dtype=float)
+        b = np.array([3, 5, 2, 3], dtype=float)
+        (x, num_iter) = upq.nnls(a, b)
+        (x_distinct, num_iter) = upq.nnls(a[:, 1:], b)
+        self.assertTrue(np.allclose(x[0] + x[1], x_distinct[0]))
+        self.assertTrue(np.allclose(x[2], x_distinct[1]))
+        self.assertTrue(np.allclose(a.dot(x), b))
+
+        (x, num_iter) = upq.nnls(a, np.zeros(4))
+        self.assertEqual(x.tolist(), [0, 0, 0])
+        self.assertEqual(num_iter, 0)
+
+    def test_gradient_rounding(self):
+        # Paths use 520 of the 3000 k-mers of the graph. The fit must be
+        # the same, to the last bit, as on the dense matrix of all k-mers.
+        rand = np.random.RandomState(0)
+        counts = rand.randint(0, 300, 3000).astype(np.float32)
+        counts[:500] = 200 + rand.randint(-20, 20, 500)
+        counts[240:260] = 400
+        counts[-20:] = 0
+        ref_path = list(range(500))
+        path = list(range(240)) + list(range(2980, 3000)) + list(range(260, 500))
+
+        quant = upq.PathQuant([path, ref_path], counts)
+        quant.compute_coef()
+        quant.refine_coef()
+        self.assertGreater(quant.num_iter, 0)
+
+        contrib = np.zeros((3000, 2), dtype=np.int32)
+        contrib[path, 0] = 1
+        contrib[ref_path, 1] = 1
+        dense_counts = counts.reshape(3000, 1)
+        coef = np.linalg.lstsq(contrib, dense_counts, rcond=None)[0]
+        coef[coef < 0] = 0
+        last_max_grad = np.inf
+        while last_max_grad > 0.01:
+            grad = np.zeros_like(coef, dtype=np.float32)
+            counts_hat = np.dot(contrib, coef)
+            for j in range(2):
+                grad[j, 0] = np.sum(2 * (dense_counts - counts_hat) *
+                                    contrib[:, j].reshape(counts_hat.shape))
+            grad /= 3000
+            coef += 0.1 * grad
+            grad[coef < 0] = 0
+            coef[coef < 0] = 0
+            last_max_grad = np.max(np.abs(grad))
+
+        self.assertEqual(quant.coef.tolist(), coef.tolist())
+
+    def test_quant_vs_ref(self):
+        ref_path = [0, 1, 2, 3, 4, 5]
+        counts = np.array([5, 5, 10, 10, 10, 10, 0, 0, 8, 20], dtype=float)
+        all_path = [
+            ref_path,                   # Same k-mers as the reference
+            [0, 1, 6, 7],               # Negative unconstrained coefficient
+            [0, 1, 2, 8, 4, 5],         # Both coefficients positive
+            [9, 9, 3, 4],               # A k-mer used twice
+            [6, 7]                      # Only zero counts
+        ]
+
+        def column(path):
+            return np.bincount(path, minlength=len(counts)).astype(float)
+
+        a = np.column_stack([column(all_path[1]), column(ref_path)])
+        self.assertLess(np.linalg.lstsq(a, counts, rcond=None)[0][0], 0)
+
+        coefs = upq.quant_vs_ref(all_path, ref_path, counts)
+        self.assertEqual(coefs.shape, (len(all_path), 2))
+        for (path, coef) in zip(all_path, coefs):
+            a = np.column_stack([column(path), column(ref_path)])
+            (x, num_iter) = upq.nnls(a, counts)
+            # Same fit, the split between identical columns aside
+            self.assertTrue(np.allclose(a.dot(coef), a.dot(x)))
+            if path != ref_path:
+                self.assertTrue(np.allclose(coef, x))
+
     def test_linear_kmin(self):
         target = "./data/catalog/GRCh38/FLT3-ITD_exons_13-15.fa"
         args = Namespace(
@@ -496,6 +759,208 @@ class kmMuttaionTest(unittest.TestCase):
                          "Test fail: linear_kmin -> wrong kmin")
 
 
+def save_sample(kmers_fn, seqs_counts, k_len=31):
+    """ Save a k-mer array where each (sequence, count) adds count to its
+    canonical k-mers. """
+    codes = []
+    counts = []
+    for (seq, count) in seqs_counts:
+        kmers = [seq[i:(i + k_len)] for i in range(len(seq) - k_len + 1)]
+        codes.append(Kmer.canonical_many(Kmer.encode_many(kmers, k_len), k_len))
+        counts.append(np.full(len(kmers), count))
+    KmerArray.from_counts(k_len, np.concatenate(codes),
+                          np.concatenate(counts)).save(kmers_fn)
+
+
+class kmSampleTest(unittest.TestCase):
+    """ Runs on synthetic k-mer arrays: a substitution in target A and an
+    insertion in target B, at other levels in sample 2. """
+
+    ref_a = "CTTTGTCATCCTCCTTACTTATAGCAAGCAGTCGTCACCGGCTTGCTGAACCAACAGCTATCTGTACGGATTTGAGATTGCATAGGTGAC"
+    ref_b = "TAATCTAACAGTGCTCATGACTGTCTTTCCGATTTTGATTGGCCTTGTGGTGTGCGTTACGTTGGTGACATATCCGTCTGTCGGATGTAC"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.targets = []
+        for (name, seq) in [("A", self.ref_a), ("B", self.ref_b)]:
+            target = os.path.join(self.tmp_dir.name, "target_%s.fa" % name)
+            with open(target, "w") as f:
+                f.write(">%s\n%s\n" % (name, seq))
+            self.targets.append(target)
+
+        alt_a = self.ref_a[:45] + "A" + self.ref_a[46:]
+        alt_b = self.ref_b[:40] + "GAT" + self.ref_b[40:]
+        self.samples = []
+        for (i, (count_a, count_b)) in enumerate([(30, 20), (8, 60)]):
+            sample = os.path.join(self.tmp_dir.name, "sample%d.kma" % (i + 1))
+            save_sample(sample, [(self.ref_a, 100), (alt_a, count_a),
+                                 (self.ref_b, 100), (alt_b, count_b)])
+            self.samples.append(sample)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def find_mut(self, jellyfish_fn, targets=None, **options):
+        """ Lines of find_mutation, without comments. """
+        settings = dict(count=5, ratio=0.05, steps=500, branchs=10)
+        settings.update(options)
+        args = Namespace(
+            graphical=False,
+            jellyfish_fn=jellyfish_fn,
+            target_fn=targets or self.targets,
+            verbose=False,
+            **settings
+        )
+
+        with captured_output() as (out, err):
+            fm.main_find_mut(args, None)
+
+        return [l for l in out.getvalue().split("\n") if l and l[0] != "#"]
+
+    def test_dead_end(self):
+        # Branches leaving the reference at two k-mers merge in a tail that
+        # leads nowhere: the second walk into the tail must be cut short
+        k_len = 11
+        tail = "GTCAGGATCCTAGCATTGCAGTACG"
+        sample = os.path.join(self.tmp_dir.name, "dead_end.kma")
+        save_sample(sample, [(self.ref_a, 100),
+                             (self.ref_a[20:31] + tail, 30),
+                             (self.ref_a[50:61] + tail, 30)], k_len)
+
+        class CountingJellyfish(Jellyfish):
+            calls = 0
+
+            def get_child_codes(self, code, forward=True):
+                self.calls += 1
+                return Jellyfish.get_child_codes(self, code, forward)
+
+        class NoPruningFinder(umf.MutationFinder):
+            # Dead ends are never remembered
+            dead_end = property(lambda self: {},
+                                lambda self, value: None)
+
+        finders = []
+        for finder_class in (umf.MutationFinder, NoPruningFinder):
+            jf = CountingJellyfish(sample, cutoff=0.05, n_cutoff=5)
+            finders.append((finder_class("dead_end", self.ref_a, jf, False),
+                            jf.calls))
+        ((finder, calls), (no_pruning, no_pruning_calls)) = finders
+
+        tail_kmers = len(tail) - k_len + 1
+        # Each k-mer of the shared tail is only walked once
+        self.assertEqual(calls, no_pruning_calls - tail_kmers)
+        self.assertTrue(finder.dead_end)
+        self.assertEqual(finder.done, no_pruning.done)
+        self.assertEqual(finder.node_data, no_pruning.node_data)
+        self.assertNotIn(Kmer.encode(tail[-k_len:]), finder.done)
+
+    def test_sample(self):
+        output = [l.split("\t") for l in self.find_mut(self.samples[0])]
+        variants = set((o[1], o[2], o[3], o[12]) for o in output)
+
+        self.assertIn(("target_A", "Substitution", "46:c/A:47", "vs_ref"),
+                      variants)
+        self.assertIn(("target_B", "Insertion", "42:/ATG:42", "vs_ref"),
+                      variants)
+
+    def test_threads(self):
+        self.assertEqual(self.find_mut(self.samples[0], threads=2),
+                         self.find_mut(self.samples[0], threads=1))
+
+    def test_db_list(self):
+        db_list = os.path.join(self.tmp_dir.name, "samples.txt")
+        with open(db_list, "w") as f:
+            f.write("# samples\n" + "\n".join(self.samples) + "\n")
+
+        # The header is written once
+        (output_1, output_2) = [self.find_mut(s) for s in self.samples]
+        self.assertEqual(self.find_mut(db_list, db_list=True),
+                         output_1 + output_2[1:])
+
+    def serve_jobs(self, jobs):
+        """ Replies of a km serve socket to jobs sent on one connection. """
+        socket_fn = os.path.join(self.tmp_dir.name, "km.sock")
+
+        async def send_jobs():
+            server = await asyncio.start_unix_server(
+                serve.make_client_handler(serve.JellyfishPool(2)),
+                path=socket_fn)
+            (reader, writer) = await asyncio.open_unix_connection(socket_fn)
+            replies = []
+            for job in jobs:
+                writer.write((json.dumps(job) + "\n").encode())
+                lines = []
+                while not lines or lines[-1] != "#End":
+                    lines.append((await reader.readline()).decode().rstrip("\n"))
+                replies.append(lines)
+            # The server closes the connection once done with every job
+            writer.write_eof()
+            self.assertEqual(await reader.read(), b"")
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return replies
+
+        return asyncio.run(send_jobs())
+
+    def test_serve(self):
+        (reply, cov_reply, error) = self.serve_jobs([
+            {"cmd": "find_mutation", "args": self.targets + [self.samples[0]]},
+            {"cmd": "min_cov", "args": [self.targets[0], self.samples[0]]},
+            {"cmd": "find_mutation", "args": ["--bogus", self.samples[0]]}
+        ])
+
+        self.assertEqual([l for l in reply if l[0] != "#"],
+                         self.find_mut(self.samples[0]))
+        with captured_output() as (out, err):
+            mc.main_min_cov(Namespace(target_fn=self.targets[0],
+                                      jellyfish_fn=[self.samples[0]]), None)
+        self.assertEqual(cov_reply, out.getvalue().split("\n")[:-1] + ["#End"])
+        self.assertEqual(len(error), 2)
+        self.assertTrue(error[0].startswith("#Error: "))
+        self.assertIn("--bogus", error[0])
+
+    def test_extract(self):
+        snapshot = os.path.join(self.tmp_dir.name, "snapshot.kma")
+        args = Namespace(count=5, ratio=0.05, steps=500, verbose=False,
+                         jellyfish_fn=self.samples[0],
+                         target_fn=self.targets, output=snapshot)
+        with captured_output() as (out, err):
+            extract.main_extract(args, None)
+
+        kmers = KmerArray.load(snapshot)
+        full = KmerArray.load(self.samples[0])
+        self.assertGreater(len(kmers), 0)
+        self.assertEqual(kmers.count_many(kmers.codes),
+                         full.count_many(kmers.codes))
+
+        # Same results, but for the database name
+        self.assertEqual(
+            [l.split("\t", 1)[1] for l in self.find_mut(snapshot)],
+            [l.split("\t", 1)[1] for l in self.find_mut(self.samples[0])])
+
+    def test_sweep(self):
+        sweep = [(0.05, 5, 500, 10), (0.1, 10, 500, 5)]
+        expected = []
+        for target in self.targets:
+            for (ratio, count, steps, branchs) in sweep:
+                label = " | p=%g c=%d s=%d b=%d" % (ratio, count, steps,
+                                                    branchs)
+                output = self.find_mut(self.samples[1], [target], ratio=ratio,
+                                       count=count, steps=steps,
+                                       branchs=branchs)
+                expected += [l + label for l in output[1:]]
+
+        output = self.find_mut(self.samples[1], sweep=sweep)
+        self.assertEqual(output[1:], expected)
+
+        # The substitution of sample 2 (count 8) is found only with -c 5
+        variants = [l for l in output if "46:c/A:47" in l]
+        self.assertTrue(variants)
+        for variant in variants:
+            self.assertTrue(variant.endswith(" | p=0.05 c=5 s=500 b=10"))
+
+
 def runTests():
     unittest.main()
 
@@ -1,5 +1,8 @@
 __all__ = [
     'find_mutation',
     'find_report',
-    'linear_kmin'
+    'linear_kmin',
+    'serve',
+    'convert',
+    'extract'
 ]
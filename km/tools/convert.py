@@ -0,0 +1,22 @@
+# convert ---
+#
+#   Usage:  jellyfish dump <jellyfish_db> | convert -o <kmer_array>
+#
+#   Write the k-mer counts given by jellyfish dump in a k-mer array, which
+#   can be used as database by the other tools without the jellyfish
+#   bindings.
+import sys
+import time
+from .. utils.KmerArray import read_dump
+
+
+# ###########################################################################
+# Main function
+def main_convert(args, argparser):
+    time_start = time.time()
+
+    kmers = read_dump(args.infile)
+    kmers.save(args.output)
+
+    sys.stderr.write("%d %d-mers written in %s (%.1fs)\n" % (
+        len(kmers), kmers.k, args.output, time.time() - time_start))
@@ -0,0 +1,44 @@
+# extract ---
+#
+#   Usage:  extract -o <kmer_array> <region_fasta or directory> <jellyfish_db>
+#
+#   Write in a k-mer array the counts of every k-mer find_mutation could
+#   query around the target sequences. The k-mer array can replace the
+#   database in find_mutation runs with ratio >= -p, count >= -c,
+#   steps <= -s and any number of branchs.
+import sys
+import time
+import logging as log
+from .. utils import MutationFinder as umf
+from .. utils import Kmer
+from .. utils import common as uc
+from .. utils.Jellyfish import Jellyfish, RecordingDB, open_db
+from . import find_mutation as fm
+
+
+# ###########################################################################
+# Main function
+def main_extract(args, argparser):
+    time_start = time.time()
+
+    if args.verbose:
+        log.basicConfig(level=log.DEBUG, format="VERBOSE: %(message)s")
+
+    db = RecordingDB(open_db(args.jellyfish_fn))
+    if db.k > Kmer.MAX_K:
+        sys.exit("ERROR: k-mer arrays hold k-mers of at most %d bases, k=%d" %
+                 (Kmer.MAX_K, db.k))
+    jf = Jellyfish(args.jellyfish_fn, cutoff=args.ratio, n_cutoff=args.count,
+                   backend=db)
+
+    seq_files = uc.target_2_seqfiles(args.target_fn)
+    for (ref_name, ref_seq, ref_mer) in fm.prepare_targets(seq_files, jf.k):
+        reached = umf.walk_neighbourhood(
+            jf, Kmer.encode_many(ref_mer, jf.k).tolist(), args.steps)
+        log.debug("%s: %d k-mers reached.", ref_name, len(reached))
+
+    kmers = db.snapshot()
+    kmers.save(args.output)
+
+    sys.stderr.write("%d %d-mers written in %s (%.1fs)\n" % (
+        len(kmers), kmers.k, args.output, time.time() - time_start))
@@ -5,9 +5,99 @@ import os
 import sys
 import time
 import logging as log
+import multiprocessing
 from .. utils import MutationFinder as umf
 from .. utils import common as uc
-from .. utils.Jellyfish import Jellyfish
+from .. utils import Kmer
+from .. utils.Jellyfish import Jellyfish, RecordingDB
+
+
+def open_jellyfish(jellyfish_fn, args):
+    return Jellyfish(jellyfish_fn, cutoff=args.ratio, n_cutoff=args.count,
+                     cache_size=getattr(args, "cache_size", 1000000))
+
+
+def prepare_targets(seq_files, k):
+    """Load each target once: (name, sequence, reference k-mers)."""
+    targets = []
+    for seq_f in seq_files:
+        (ref_name, ext) = os.path.splitext(os.path.basename(seq_f))
+        ref_seq = uc.file_2_seq(seq_f)
+        ref_mer = uc.get_ref_kmer(ref_seq, k, ref_name)
+        targets.append((ref_name, ref_seq, ref_mer))
+    return targets
+
+
+def find_mut_target(target, jf, args):
+    """Run MutationFinder on one target, returns its sorted output lines."""
+    (ref_name, ref_seq, ref_mer) = target
+    if ref_mer and len(ref_mer[0]) != jf.k:
+        # Target prepared for a database with another k
+        ref_mer = None
+    if getattr(args, "sweep", None):
+        return find_mut_sweep((ref_name, ref_seq, ref_mer), jf, args)
+
+    finder = umf.MutationFinder(
+        ref_name, ref_seq, jf,
+        args.graphical, args.steps, args.branchs,
+        getattr(args, "compact", False), ref_mer,
+        getattr(args, "solver", "gradient")
+    )
+
+    return [str(path) for path in finder.get_paths(sort=True)]
+
+
+def find_mut_sweep(target, jf, args):
+    """Run MutationFinder on one target for each setting of args.sweep.
+
+    The k-mers around the target are queried once with the most permissive
+    setting, each setting being then run on this in-memory snapshot.
+    """
+    (ref_name, ref_seq, ref_mer) = target
+    if ref_mer is None:
+        ref_mer = uc.get_ref_kmer(ref_seq, jf.k, ref_name)
+
+    db = RecordingDB(jf.db)
+    walker = Jellyfish(jf.filename,
+                       cutoff=min(s[0] for s in args.sweep),
+                       n_cutoff=min(s[1] for s in args.sweep),
+                       backend=db)
+    umf.walk_neighbourhood(walker, Kmer.encode_many(ref_mer, jf.k).tolist(),
+                           max(s[2] for s in args.sweep))
+    kmers = db.snapshot()
+    log.debug("%s: %d k-mers kept for the sweep.", ref_name, len(kmers))
+
+    lines = []
+    for (ratio, count, steps, branchs) in args.sweep:
+        sub_jf = Jellyfish(jf.filename, cutoff=ratio, n_cutoff=count,
+                           backend=kmers)
+        finder = umf.MutationFinder(
+            ref_name, ref_seq, sub_jf,
+            args.graphical, steps, branchs,
+            getattr(args, "compact", False), ref_mer,
+            getattr(args, "solver", "gradient")
+        )
+        label = " | p=%g c=%d s=%d b=%d" % (ratio, count, steps, branchs)
+        for path in finder.get_paths(sort=True):
+            path.note += label
+            lines.append(str(path))
+    return lines
+
+
+# ###########################################################################
+# Worker processes: each one keeps its own handle on the last database used
+_worker_jf = None
+
+
+def _find_mut_worker(task):
+    global _worker_jf
+    (jellyfish_fn, target, args) = task
+    if _worker_jf is None or _worker_jf.filename != jellyfish_fn:
+        _worker_jf = open_jellyfish(jellyfish_fn, args)
+    (hits, misses) = (_worker_jf.hits, _worker_jf.misses)
+    lines = find_mut_target(target, _worker_jf, args)
+    # Cache statistics of this target, summed by database in the main process
+    return (lines, _worker_jf.hits - hits, _worker_jf.misses - misses)
 
 
 # ###########################################################################
@@ -21,24 +111,45 @@ def main_find_mut(args, argparser):
     for k, v in vars(args).items():
         sys.stdout.write("#" + str(k) + ':' + str(v) + "\n")
 
-    jf = Jellyfish(args.jellyfish_fn, cutoff=args.ratio, n_cutoff=args.count)
-
+    jf_files = uc.jellyfish_2_dbfiles(args.jellyfish_fn,
+                                      getattr(args, "db_list", False))
     seq_files = uc.target_2_seqfiles(args.target_fn)
 
-    umf.MutationFinder.output_header()
+    # Targets are parsed and checked once, for the k of the first database
+    jf = open_jellyfish(jf_files[0], args)
+    targets = prepare_targets(seq_files, jf.k)
 
-    for seq_f in seq_files:
+    tasks = [(jf_fn, target, args) for jf_fn in jf_files for target in targets]
+    threads = min(getattr(args, "threads", 1), len(tasks))
+    if args.graphical and threads > 1:
+        log.debug("Graphical output, targets are processed serially.")
+        threads = 1
 
-        (ref_name, ext) = os.path.splitext(os.path.basename(seq_f))
-
-        ref_seq = uc.file_2_seq(seq_f)
-
-        finder = umf.MutationFinder(
-            ref_name, ref_seq, jf,
-            args.graphical, args.steps, args.branchs
-        )
+    umf.MutationFinder.output_header()
 
-        for path in finder.get_paths(sort=True):
-            sys.stdout.write(str(path) + "\n")
+    if threads > 1:
+        # Give whole samples to workers when there are enough of them,
+        # imap keeps the order of a serial run
+        chunksize = len(targets) if len(jf_files) >= threads else 1
+        cache_stats = {jf_fn: [0, 0] for jf_fn in jf_files}
+        with multiprocessing.Pool(threads) as pool:
+            results = pool.imap(_find_mut_worker, tasks, chunksize)
+            for (task, (lines, hits, misses)) in zip(tasks, results):
+                for line in lines:
+                    sys.stdout.write(line + "\n")
+                cache_stats[task[0]][0] += hits
+                cache_stats[task[0]][1] += misses
+        for jf_fn in jf_files:
+            log.debug("%s k-mer cache: %d hits, %d misses.",
+                      jf_fn, *cache_stats[jf_fn])
+    else:
+        for jf_fn in jf_files:
+            if jf.filename != jf_fn:
+                jf = open_jellyfish(jf_fn, args)
+            for target in targets:
+                for line in find_mut_target(target, jf, args):
+                    sys.stdout.write(line + "\n")
+            log.debug("%s k-mer cache: %d hits, %d misses.",
+                      jf_fn, jf.hits, jf.misses)
 
     sys.stdout.write("#Elapsed time:" + str(time.time() - time_start) + "\n")
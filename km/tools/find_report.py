@@ -2,18 +2,35 @@ import sys
 import re
 
 from .. utils import common as uc
+from .. utils.Jellyfish import Jellyfish
 
 
-def print_line(sample, region, location, type_var, removed,
-               added, abnormal, normal, ratio, min_cov, min_exclu,
-               variant, target, info, var_seq, ref_seq):
-    line = "\t".join([sample, region, location, type_var, removed,
+class OutputBuffer:
+    """ Collects output lines, written to stdout in large blocks. """
+
+    def __init__(self, size=8192):
+        self.lines = []
+        self.size = size
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.size:
+            self.flush()
+
+    def flush(self):
+        sys.stdout.write("".join(self.lines))
+        self.lines = []
+
+
+def format_line(sample, region, location, type_var, removed,
+                added, abnormal, normal, ratio, min_cov, min_exclu,
+                variant, target, info, var_seq, ref_seq):
+    return "\t".join([sample, region, location, type_var, removed,
                       added, abnormal, normal, ratio, min_cov, min_exclu,
-                      variant, target, info, var_seq, ref_seq])
-    sys.stdout.write(line + "\n")
+                      variant, target, info, var_seq, ref_seq]) + "\n"
 
 
-def print_vcf_header():
+def format_vcf_header():
     header  = '##fileformat=VCFv4.1\n'
     header += '##INFO=<ID=TYPE,Number=A,Type=String,Description='
     header += '"The type of variant, either Insertion, ITD, I&I, Deletion, Substitution or Indel.">\n'
@@ -25,14 +42,13 @@ def print_vcf_header():
     header += '##INFO=<ID=REMOVED,Number=A,Type=String,Description="Number of removed bases.">\n'
     header += '##INFO=<ID=ADDED,Number=A,Type=String,Description="Number of added bases.">\n'
     header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
-    sys.stdout.write(header)
+    return header
 
 
-def print_vcf_line(chro, loc, ref_var, alt_var, type_var, target, ratio, min_cov, rem, ad):
-    line = "\t".join([chro, str(loc), ".", ref_var, alt_var, ".", ".",
+def format_vcf_line(chro, loc, ref_var, alt_var, type_var, target, ratio, min_cov, rem, ad):
+    return "\t".join([chro, str(loc), ".", ref_var, alt_var, ".", ".",
                       "TYPE="+type_var+";TARGET="+target+";RATIO="+ratio+";MINCOV="+min_cov +
-                      ";REMOVED="+str(rem)+";ADDED="+str(ad)])
-    sys.stdout.write(line + "\n")
+                      ";REMOVED="+str(rem)+";ADDED="+str(ad)]) + "\n"
 
 
 def init_ref_seq(arg_ref):
@@ -78,13 +94,18 @@ def init_ref_seq(arg_ref):
 
 def create_report(args):
 
-    # Find correct extremities of a mutation
-    sys.setrecursionlimit(10000)
-
+    # Find correct extremities of a mutation: shift va to the left while
+    # the preceding base of rs equals its last base, va being rotated by
+    # one base at each shift (tracked with the index j of its last base)
     def get_extremities(va, p, rs):
-        if p - 1 > 0 and rs[p - 1] == va[-1]:
-            return get_extremities(rs[p - 1] + va[:-1], p - 1, rs)
+        j = len(va) - 1
+        while p - 1 > 0 and rs[p - 1] == va[j]:
+            p -= 1
+            j = j - 1 if j > 0 else len(va) - 1
         return p - 1
+
+    # Upper case and reversed copies of each reference sequence
+    ref_seqs = {}
     
     if args.format == "vcf" and args.info == "cluster":
         # Note: could salvage that option if we get the fill ref from vs_ref entries
@@ -98,26 +119,41 @@ def create_report(args):
 
     (nts, chro, strand) = init_ref_seq(args.target)
 
+    out = OutputBuffer()
     if vcf:
-        print_vcf_header()
+        out.write(format_vcf_header())
     elif not table:
-        print_line("Sample", "Region", "Location", "Type", "Removed",
-                   "Added", "Abnormal", "Normal", "Ratio", "Min_coverage",
-                   "Exclu_min_cov", "Variant", "Target", "Info", "Variant_sequence",
-                   "Reference_sequence")
+        out.write(format_line("Sample", "Region", "Location", "Type", "Removed",
+                              "Added", "Abnormal", "Normal", "Ratio", "Min_coverage",
+                              "Exclu_min_cov", "Variant", "Target", "Info", "Variant_sequence",
+                              "Reference_sequence"))
+
+    info_filter = re.compile(args.info)
+
+    # The exclusion database is opened once, and the min coverage of each
+    # distinct variant sequence computed once
+    exclu_jf = Jellyfish(args.exclu) if args.exclu != "" else None
+    exclu_min = {}
 
     for line in args.infile:
         # filter header
         if line[0] == "#":
             # sys.stderr.write("Filtred: " + line)
             continue
-        
-        tok = line.strip("\n").split("\t")
-        
-        # filter on info column
-        if not re.search(args.info, line) or tok[0] == "Database" or len(tok) <= 1:
+
+        # filter on info column, the last one, before parsing the line
+        line = line.rstrip("\n")
+        last_tab = line.rfind("\t")
+        if last_tab == -1 or not info_filter.search(line, last_tab + 1):
             # sys.stderr.write("Filtered: " + line)
             continue
+
+        tok = line.split("\t")
+        if tok[0] == "Database":
+            continue
+
+        if int(tok[6]) < args.min_cov:
+            continue
         
         samp = tok[0]
         query = tok[1]
@@ -132,14 +168,15 @@ def create_report(args):
         
         min_exclu = "" 
         variant = (tok[2], tok[3])
-        ref_seq = refSeq.upper()
+        if refSeq not in ref_seqs:
+            upper = refSeq.upper()
+            ref_seqs[refSeq] = (upper, upper[::-1])
+        (ref_seq, ref_rev) = ref_seqs[refSeq]
         
-        if args.exclu != "" and alt_seq != "":
-            res = uc.get_cov(args.exclu, alt_seq)
-            min_exclu = str(res[2])
-        
-        if int(min_cov) < args.min_cov:
-            continue
+        if exclu_jf is not None and alt_seq != "":
+            if alt_seq not in exclu_min:
+                exclu_min[alt_seq] = str(uc.get_cov(exclu_jf, alt_seq)[2])
+            min_exclu = exclu_min[alt_seq]
         
         # case: entries with no mutations
         if variant[0] == 'Reference':
@@ -149,9 +186,9 @@ def create_report(args):
             else:
                 region = "{}:{}-{}".format(chro, nts[0], nts[-1])
             if not vcf and not table:
-                print_line(samp, region, '-', variant[0], '0', '0',
-                           '0.0', alt_exp, tok[4], min_cov, min_exclu, '-',
-                           query, tok[-1], "", "")
+                out.write(format_line(samp, region, '-', variant[0], '0', '0',
+                                      '0.0', alt_exp, tok[4], min_cov, min_exclu, '-',
+                                      query, tok[-1], "", ""))
                 continue
             elif vcf:
                 continue
@@ -196,8 +233,8 @@ def create_report(args):
                 var = insert.upper()
                 ibef = get_extremities(var, pos, ref_seq)  # include current position
                 before = ref_seq[ibef:pos]
-                iaft = get_extremities(var[::-1], len(ref_seq)-pos, ref_seq[::-1])
-                after = ref_seq[::-1][iaft:len(ref_seq)-pos][::-1]
+                iaft = get_extremities(var[::-1], len(ref_seq)-pos, ref_rev)
+                after = ref_rev[iaft:len(ref_seq)-pos][::-1]
                 iaft = len(ref_seq) - iaft - 1
                 ref_var = before + after
                 alt_var = before + var + after
@@ -236,8 +273,8 @@ def create_report(args):
                 var = delet.upper()
                 ibef = get_extremities(var, pos, ref_seq)
                 before = ref_seq[ibef:pos]
-                iaft = get_extremities(var[::-1], len(ref_seq)-pos-1-len(var)+1, ref_seq[::-1])
-                after = ref_seq[::-1][iaft:len(ref_seq)-pos-1-len(var)+1][::-1]
+                iaft = get_extremities(var[::-1], len(ref_seq)-pos-1-len(var)+1, ref_rev)
+                after = ref_rev[iaft:len(ref_seq)-pos-1-len(var)+1][::-1]
                 iaft = len(ref_seq) - iaft - 1
                 ref_var = before + var + after
                 alt_var = before + after
@@ -271,21 +308,22 @@ def create_report(args):
             else:
                 sys.stderr.write("WARNING: This variant isn't taken account\n")
                 sys.stderr.write(" - variant: " + str(variant[0]) + "\n")
-                sys.stderr.write(" - line: " + line)
+                sys.stderr.write(" - line: " + line + "\n")
+                out.flush()
                 sys.exit()
 
         if not vcf and not table:
-            print_line(samp, region, location, insert_type,
-                       removed, added, alt_exp, ref_exp, ratio,
-                       min_cov, min_exclu, mod, query, info,
-                       alt_seq, refSeq)
+            out.write(format_line(samp, region, location, insert_type,
+                                  removed, added, alt_exp, ref_exp, ratio,
+                                  min_cov, min_exclu, mod, query, info,
+                                  alt_seq, refSeq))
             
         elif vcf:
             complement = str.maketrans('ATGCU', 'TACGA')
             ref_var = ref_var.translate(complement)[::-1] if strand == '-' else ref_var
             alt_var = alt_var.translate(complement)[::-1] if strand == '-' else alt_var
-            print_vcf_line(chro, loc_var, ref_var, alt_var, insert_type,
-                           query, ratio, min_cov, removed, added.replace(" ", ""))
+            out.write(format_vcf_line(chro, loc_var, ref_var, alt_var, insert_type,
+                                      query, ratio, min_cov, removed, added.replace(" ", "")))
             
         elif table:
             var_name = variant[0] + "/" + query if "/" not in variant[0] else variant[0]
@@ -306,25 +344,27 @@ def create_report(args):
     if table:
         sorted_variants = sorted(variants, key=variants.get, reverse=True)
         
-        sys.stdout.write("Sample")
+        header = ["Sample"]
         for v in sorted_variants:
             if v[0].split("/")[0] == "Reference":
-                sys.stdout.write("\t" + v[0])
+                header.append(v[0])
             else:
-                sys.stdout.write("\t" + v[1])
-        sys.stdout.write("\n")
-        
+                header.append(v[1])
+        out.write("\t".join(header) + "\n")
+
         for s, sv in samples.items():
-            sys.stdout.write(s)
+            row = [s]
             for v in sorted_variants:
                 if v in sv:
                     if 'Reference' not in v[0] and (not data[s][v]):
-                        sys.stdout.write("\t" + ".")
+                        row.append(".")
                     else:
-                        sys.stdout.write("\t" + str(data[s][v]))
+                        row.append(str(data[s][v]))
                 else:
-                    sys.stdout.write("\t" + ".")
-            sys.stdout.write("\n")
+                    row.append(".")
+            out.write("\t".join(row) + "\n")
+
+    out.flush()
 
 
 def main_find_report(args, argparser):
@@ -10,6 +10,16 @@ from .. utils import common as uc
 from .. utils.Jellyfish import Jellyfish
 
 
+# Columns of the min_cov output, one line per database
+HEADER = "DB\tcount\tlength\tmin\tmax\tmean\tkmer_nb\tkmer_nb_0"
+
+
+def format_cov(jf_file, res):
+    return "%s\t%d\t%d\t%d\t%d\t%.2f\t%d\t%d" % (
+           jf_file, res[0], res[1], res[2], res[3],
+           res[4], res[5], res[6])
+
+
 # ###########################################################################
 # Main function
 def main_min_cov(args, argparser):
@@ -19,11 +29,8 @@ def main_min_cov(args, argparser):
     if os.path.isfile(args.target_fn):
         ref_seq = uc.file_2_seq(args.target_fn)
 
-    sys.stdout.write("DB\tcount\tlength\tmin\tmax\tmean\tkmer_nb\tkmer_nb_0\n")
+    sys.stdout.write(HEADER + "\n")
 
     for jf_file in lst_files:
         res = uc.get_cov(jf_file, ref_seq)
-        res_str = "%s\t%d\t%d\t%d\t%d\t%.2f\t%d\t%d" % (
-                  jf_file, res[0], res[1], res[2], res[3],
-                  res[4], res[5], res[6])
-        sys.stdout.write(res_str + "\n")
+        sys.stdout.write(format_cov(jf_file, res) + "\n")
@@ -0,0 +1,182 @@
+# serve ---
+#
+#   Usage:  serve [-s socket]
+#
+#   Keep jellyfish databases open and run jobs sent on a unix socket. A job
+#   is one JSON line giving a command and its command line arguments, as in:
+#     {"cmd": "find_mutation", "args": ["-p", "0.1", "target.fa", "db.jf"]}
+#   Results are streamed back as the command would print them, followed by
+#   a line "#End".
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+import logging as log
+from collections import OrderedDict
+
+from .. argparser.find_mutation import get_argparser_find_mut
+from .. argparser.min_cov import get_argparser_min_cov
+from .. utils import common as uc
+from .. utils import PathQuant as upq
+from .. utils.Jellyfish import Jellyfish
+from . import find_mutation as fm
+from . import min_cov as mc
+
+
+class JellyfishPool:
+    """Opened Jellyfish handles, the least recently used is closed first."""
+
+    def __init__(self, max_open, cache_size=1000000):
+        self.max_open = max_open
+        self.cache_size = cache_size
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """Returns (jf, lock), lock must be held while jf is in use."""
+        with self.lock:
+            if filename in self.handles:
+                self.handles.move_to_end(filename)
+            else:
+                log.debug("Opening %s", filename)
+                jf = Jellyfish(filename, cache_size=self.cache_size)
+                self.handles[filename] = (jf, threading.Lock())
+                if len(self.handles) > self.max_open:
+                    self.handles.popitem(last=False)
+            return self.handles[filename]
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    """Parser of job arguments, raising errors (sent back to the client)
+    instead of printing them and exiting the server."""
+
+    def error(self, message):
+        raise ValueError(message)
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or "exit requested by arguments")
+
+
+def _parse_job_args(get_argparser, job_args):
+    parser = JobArgumentParser(prog="km")
+    get_argparser(parser)
+    return parser.parse_args(job_args)
+
+
+def run_find_mutation(job_args, pool, emit):
+    args = _parse_job_args(get_argparser_find_mut, job_args)
+    time_start = time.time()
+
+    jf_files = uc.jellyfish_2_dbfiles(args.jellyfish_fn, args.db_list)
+    seq_files = uc.target_2_seqfiles(args.target_fn)
+
+    emit(upq.HEADER + "\n")
+
+    targets = {}
+    for jf_fn in jf_files:
+        (jf, lock) = pool.get(jf_fn)
+        with lock:
+            jf.cutoff = args.ratio
+            jf.n_cutoff = args.count
+            if jf.k not in targets:
+                targets[jf.k] = fm.prepare_targets(seq_files, jf.k)
+            for target in targets[jf.k]:
+                for line in fm.find_mut_target(target, jf, args):
+                    emit(line + "\n")
+
+    emit("#Elapsed time:" + str(time.time() - time_start) + "\n")
+
+
+def run_min_cov(job_args, pool, emit):
+    args = _parse_job_args(get_argparser_min_cov, job_args)
+
+    ref_seq = args.target_fn
+    if os.path.isfile(args.target_fn):
+        ref_seq = uc.file_2_seq(args.target_fn)
+
+    emit(mc.HEADER + "\n")
+
+    for jf_file in uc.args_2_list_files(args.jellyfish_fn):
+        (jf, lock) = pool.get(jf_file)
+        with lock:
+            res = uc.get_cov(jf, ref_seq)
+        emit(mc.format_cov(jf_file, res) + "\n")
+
+
+JOBS = {
+    "find_mutation": run_find_mutation,
+    "min_cov": run_min_cov
+}
+
+
+def run_job(line, pool, emit):
+    try:
+        job = json.loads(line)
+        if job.get("cmd") not in JOBS:
+            raise ValueError("unknown command %s" % job.get("cmd"))
+        JOBS[job["cmd"]](job.get("args", []), pool, emit)
+    except Exception as e:
+        log.debug("Job failed: %s", line)
+        emit("#Error: " + str(e) + "\n")
+    finally:
+        emit("#End\n")
+        emit(None)
+
+
+def make_client_handler(pool):
+    async def handle_client(reader, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            # The job runs in a worker thread and streams its output
+            # through this queue, None marking its end
+            queue = asyncio.Queue()
+
+            def emit(text):
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+
+            job = loop.run_in_executor(None, run_job, line.decode(), pool, emit)
+            while True:
+                text = await queue.get()
+                if text is None:
+                    break
+                writer.write(text.encode())
+                await writer.drain()
+            await job
+        writer.close()
+
+    return handle_client
+
+
+# ###########################################################################
+# Main function
+def main_serve(args, argparser):
+    if args.verbose:
+        log.basicConfig(level=log.DEBUG, format="VERBOSE: %(message)s")
+
+    pool = JellyfishPool(args.max_open, args.cache_size)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        asyncio.start_unix_server(make_client_handler(pool), path=args.socket))
+    sys.stderr.write("km serve: listening on %s\n" % args.socket)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
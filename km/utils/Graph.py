@@ -2,16 +2,31 @@
 # Graph.py --- Generic graph class (directed, weighted)
 #
 
+import heapq
 import logging as log
 import numpy as np
 
 class Graph:
     ## Nodes are identified by 0..(n-1)
+    ## Edge weights are kept in a dense n x n matrix, or in per-node
+    ## adjacency dicts (successors and predecessors) for large graphs.
 
-    def __init__(self, n):
+    # Node count above which the sparse representation is used by default
+    sparse_threshold = 2000
+
+    def __init__(self, n, sparse=None):
         self.n = n
-        self.w = np.empty((n, n), dtype=np.float32)
-        self.w.fill(np.inf)
+        if sparse is None:
+            sparse = n > Graph.sparse_threshold
+        self.sparse = sparse
+
+        if self.sparse:
+            self.w = None
+            self.succ = [{} for i in range(n)]
+            self.pred = [{} for i in range(n)]
+        else:
+            self.w = np.empty((n, n), dtype=np.float32)
+            self.w.fill(np.inf)
         self.edge_set = set()
 
         self.first_node = 0
@@ -23,52 +38,138 @@ class Graph:
 
     def __getitem__(self, indices):
         (i, j) = indices
+        if self.sparse:
+            return self.succ[i].get(j, np.float32(np.inf))
         return self.w[i, j]
 
     def __setitem__(self, indices, new_val):
         (i, j) = indices
-        self.w[i, j] = new_val
+        if self.sparse:
+            self.succ[i][j] = np.float32(new_val)
+            self.pred[j][i] = np.float32(new_val)
+        else:
+            self.w[i, j] = new_val
         self.edge_set.add((i, j))
 
-    def _get_paths(self, start, w):
+    def _neighbours(self, i, forward=True):
+        # Returns (nodes, weights) of the out-edges of i,
+        # or of its in-edges when not forward
+        if self.sparse:
+            adj = self.succ[i] if forward else self.pred[i]
+            return (list(adj.keys()), list(adj.values()))
+        row = self.w[i, :] if forward else self.w[:, i]
+        nodes = np.flatnonzero(row != np.inf)
+        return (nodes, row[nodes])
+
+    def _get_paths(self, start, forward=True):
+        # Dijkstra on a binary heap. Among nodes at the same distance, the
+        # highest node number is visited first.
         prev = np.empty(self.n, dtype=np.int32)
         prev.fill(-1)
         dist = np.empty(self.n, dtype=np.float32)
         dist.fill(np.inf)
-        unvisited = set(range(self.n))
-
-        def visit(i):
-            ndist = w[i, :] + dist[i]
-            for j in range(self.n):
-                if ndist[j] < dist[j]:
-                    dist[j] = ndist[j]
-                    prev[j] = i
+        visited = np.zeros(self.n, dtype=bool)
 
         dist[start] = 0
-        visit(start)
-        unvisited.remove(start)
-
-        def min_unvisited():
-            min_i = -1
-            min_dist = np.inf
-            for i in unvisited:
-                if dist[i] <= min_dist:
-                    min_i = i
-                    min_dist = dist[i]
-            return min_i
-
-        while unvisited:
-            i = min_unvisited()
-            unvisited.remove(i)
-            visit(i)
+        heap = [(0.0, -start)]
+        while heap:
+            (d, i) = heapq.heappop(heap)
+            i = -i
+            if visited[i] or d > dist[i]:
+                continue
+            visited[i] = True
+
+            (nodes, weights) = self._neighbours(i, forward)
+            for (j, w_ij) in zip(nodes, weights):
+                ndist = w_ij + dist[i]
+                if ndist < dist[j]:
+                    dist[j] = ndist
+                    prev[j] = i
+                    heapq.heappush(heap, (float(ndist), -j))
 
         return prev
 
+    def compact(self, protected=()):
+        # Returns a new Graph where each non-branching chain of nodes is
+        # collapsed in a single unitig node. The new graph's unitigs gives
+        # the nodes of each unitig, and unitig_of the unitig of each node.
+        # Entering a unitig costs the weight of its incoming edge plus the
+        # weights along the chain. Protected nodes are kept alone.
+        # Shortest paths ties are broken on unitig numbers, so among paths
+        # of equal cost another one than on this graph may be found.
+        protected = set(protected)
+        succ = [self._neighbours(i, True) for i in range(self.n)]
+        in_deg = np.zeros(self.n, dtype=np.int32)
+        for (nodes, weights) in succ:
+            in_deg[nodes] += 1
+
+        def single_succ(i):
+            (nodes, weights) = succ[i]
+            if len(nodes) != 1:
+                return (-1, 0)
+            return (nodes[0], weights[0])
+
+        def chained(i, j):
+            # j directly extends i inside a unitig
+            return (j != -1 and j != i and in_deg[j] == 1 and
+                    i not in protected and j not in protected)
+
+        has_pred = np.zeros(self.n, dtype=bool)
+        for i in range(self.n):
+            (j, w_ij) = single_succ(i)
+            if chained(i, j):
+                has_pred[j] = True
+
+        unitig_of = np.empty(self.n, dtype=np.int32)
+        unitig_of.fill(-1)
+        unitigs = []
+        internal = []
+
+        def build(head):
+            nodes = [head]
+            cost = 0.0
+            unitig_of[head] = len(unitigs)
+            (j, w_ij) = single_succ(head)
+            while chained(nodes[-1], j) and unitig_of[j] == -1:
+                nodes.append(j)
+                cost += w_ij
+                unitig_of[j] = len(unitigs)
+                (j, w_ij) = single_succ(j)
+            unitigs.append(nodes)
+            internal.append(cost)
+
+        for i in range(self.n):
+            if not has_pred[i]:
+                build(i)
+        # Remaining nodes are on isolated cycles
+        for i in range(self.n):
+            if unitig_of[i] == -1:
+                build(i)
+
+        log.debug("Compacted %d nodes in %d unitigs.", self.n, len(unitigs))
+
+        graph = Graph(len(unitigs))
+        graph.unitigs = unitigs
+        graph.unitig_of = unitig_of
+        for (u, nodes) in enumerate(unitigs):
+            (targets, weights) = succ[nodes[-1]]
+            for (j, w_ij) in zip(targets, weights):
+                v = unitig_of[j]
+                graph[u, v] = w_ij + internal[v]
+        return graph
+
+    def expand(self, path):
+        # Returns the nodes of the original graph along a path of unitigs
+        nodes = []
+        for u in path:
+            nodes.extend(self.unitigs[u])
+        return tuple(nodes)
+
     def init_paths(self, first_node, last_node):
         self.first_node = first_node
         self.last_node = last_node
-        self.before = self._get_paths(self.first_node, self.w)
-        self.after = self._get_paths(self.last_node, self.w.transpose())
+        self.before = self._get_paths(self.first_node, forward=True)
+        self.after = self._get_paths(self.last_node, forward=False)
         # Load up and remove edges from the ref path
         path = [self.first_node]
         cur = self.first_node
@@ -100,15 +201,78 @@ class Graph:
             return None
         return path
 
-    def all_shortest(self):
-        all_paths = set()
+    def all_shortest(self, one_pass=True):
+        # Returns every distinct shortest path through a non-ref edge.
+        # In one_pass mode, paths are only expanded once per distinct
+        # (entry on ref, variant nodes, exit on ref) key instead of once
+        # per edge.
         log.debug("%d edges in non-ref edge set.", len(self.edge_set))
+        if not one_pass or self.ref_path[-1] != self.last_node:
+            all_paths = set()
+            for (i, j) in self.edge_set:
+                log.debug("Computing shortest path through edge: (%d, %d)", i, j)
+                path = self.get_shortest(i, j)
+                if path:
+                    all_paths.add(tuple(path))
+            return list(all_paths)
+
+        ref = self.ref_path
+        # Ref positions of the nodes reached from first_node through a
+        # prefix of the ref path, and of those reaching last_node through
+        # a suffix of it.
+        prefix = {}
+        for (pos, node) in enumerate(ref):
+            if pos > 0 and self.before[node] != ref[pos - 1]:
+                break
+            prefix[node] = pos
+        suffix = {}
+        for pos in range(len(ref) - 1, -1, -1):
+            node = ref[pos]
+            if pos < len(ref) - 1 and self.after[node] != ref[pos + 1]:
+                break
+            suffix[node] = pos
+
+        def follow(start, prev, anchors):
+            # Nodes from start up to the first anchor, and its ref position
+            nodes = []
+            cur = start
+            while cur != -1 and cur not in anchors:
+                nodes.append(cur)
+                cur = prev[cur]
+            if cur == -1:
+                return (nodes, None)
+            return (nodes, anchors[cur])
+
+        keys = {}
         for (i, j) in self.edge_set:
-            log.debug("Computing shortest path through edge: (%d, %d)", i, j)
-            path = self.get_shortest(i, j)
-            if path:
-                all_paths.add(tuple(path))
-        return list(all_paths)
+            (head, entry) = follow(i, self.before, prefix)
+            (tail, exit) = follow(j, self.after, suffix)
+            ## Only keep paths from source to sink
+            if entry is None or exit is None:
+                continue
+
+            # Extend the ref flanks as far as the path follows the ref,
+            # so that a path has the same key whichever edge it came from
+            middle = head[::-1] + tail
+            start = 0
+            stop = len(middle)
+            while (start < stop and entry + 1 < len(ref) and
+                    middle[start] == ref[entry + 1]):
+                entry += 1
+                start += 1
+            while stop > start and exit > 0 and middle[stop - 1] == ref[exit - 1]:
+                exit -= 1
+                stop -= 1
+            middle = tuple(middle[start:stop])
+            if not middle and exit == entry + 1:
+                # The reference path itself
+                (entry, exit) = (len(ref) - 1, len(ref))
+
+            if (entry, middle, exit) not in keys:
+                keys[(entry, middle, exit)] = tuple(ref[:entry + 1]) + middle + tuple(ref[exit:])
+
+        # Same ordering as the set of paths built by the per-edge mode
+        return list(set(keys.values()))
 
     def diff_path_without_overlap(self, ref, seq, k):
         # Returns (start, stop_ref, stop_variant, kmers_ref, kmers_variant, stop_ref_fully_trimmed)
@@ -5,36 +5,183 @@
 import os
 import sys
 import logging as log
-import jellyfish
+import numpy as np
 
+from collections import OrderedDict
 
-class Jellyfish:
+from . import Kmer
+from .KmerArray import KmerArray, is_kmer_array
+
+
+class JellyfishDB:
+    """ Counts from a jellyfish database, through the jellyfish bindings. """
 
-    def __init__(self, filename, cutoff=0.30, n_cutoff=500, canonical=True):
+    def __init__(self, filename):
+        # Imported here, so that km runs on k-mer arrays without the bindings
+        import jellyfish
+        self.mer = jellyfish.MerDNA
         self.jf = jellyfish.QueryMerFile(filename)
         self.k = jellyfish.MerDNA.k()
+
+    def count_many(self, codes):
+        return [self.jf[self.mer(kmer)]
+                for kmer in Kmer.decode_many(codes, self.k)]
+
+
+class RecordingDB:
+    """ Wraps a count backend, keeping every count queried through it. """
+
+    def __init__(self, db):
+        self.db = db
+        self.k = db.k
+        self.counts = {}
+
+    def count_many(self, codes):
+        counts = self.db.count_many(codes)
+        self.counts.update(zip(codes, counts))
+        return counts
+
+    def snapshot(self):
+        """ KmerArray of the non-zero counts queried so far (a CountDict
+        for k-mers too long for a KmerArray). """
+        found = [(c, n) for (c, n) in self.counts.items() if n > 0]
+        if self.k > Kmer.MAX_K:
+            return CountDict(self.k, dict(found))
+        return KmerArray.from_counts(self.k, [c for (c, n) in found],
+                                     [n for (c, n) in found])
+
+
+class CountDict:
+    """ Counts kept in a dict of codes, for any k. """
+
+    def __init__(self, k, counts):
+        self.k = k
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def count_many(self, codes):
+        return [self.counts.get(c, 0) for c in codes]
+
+
+BACKENDS = {
+    "jellyfish": JellyfishDB,
+    "array": KmerArray.load
+}
+
+
+def open_db(filename, backend=None):
+    """ Open a count backend, found from the file header if not given. """
+    if backend is None:
+        backend = "array" if is_kmer_array(filename) else "jellyfish"
+    if backend not in BACKENDS:
+        raise ValueError("Unknown count backend %s" % backend)
+    return BACKENDS[backend](filename)
+
+
+class Jellyfish:
+    """ Front-end to query k-mer counts.
+
+    The counts come from a backend: a jellyfish database, a k-mer array
+    (see KmerArray), or any opened object giving k and count_many(codes).
+    """
+
+    def __init__(self, filename, cutoff=0.30, n_cutoff=500, canonical=True,
+                 cache_size=1000000, backend=None):
+        if backend is None or isinstance(backend, str):
+            self.db = open_db(filename, backend)
+        else:
+            self.db = backend
+        self.k = self.db.k
         self.filename = filename
         self.cutoff = cutoff
         self.n_cutoff = n_cutoff
         self.canonical = canonical
 
+        # LRU cache of counts, keyed by (canonical) k-mer code
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
     def query(self, seq):
-        kmer = jellyfish.MerDNA(seq)
-        if (self.canonical):
-            kmer.canonicalize()
-        return self.jf[kmer]
+        code = Kmer.encode(seq)
+        if self.canonical:
+            code = Kmer.canonical(code, self.k)
+        return self._counts([code])[0]
 
-    def get_child(self, seq, forward=True):
-        child = []
-        sum = 0
-        for c in ['A', 'C', 'G', 'T']:
-            if forward:
-                c_seq = seq[1:] + c
+    def query_many(self, seqs):
+        """ Query a batch of k-mers given as strings. """
+        seqs = list(seqs)
+        if len(seqs) < Kmer.SMALL_BATCH:
+            return self.query_codes([Kmer.encode(s) for s in seqs])
+        return self.query_codes(Kmer.encode_many(seqs, self.k))
+
+    def query_codes(self, codes):
+        """ Query a batch of encoded k-mers, returns a numpy array of counts.
+
+        Canonicalization is done once for the whole batch (k-mer by k-mer
+        for small batches) and each distinct k-mer is looked up only once,
+        in the cache or in the database.
+        """
+        if not self.canonical:
+            keys = [int(c) for c in codes]
+        elif len(codes) < Kmer.SMALL_BATCH:
+            keys = [Kmer.canonical(int(c), self.k) for c in codes]
+        else:
+            keys = Kmer.canonical_many(codes, self.k).tolist()
+        return np.array(self._counts(keys), dtype=np.int64)
+
+    def _counts(self, keys):
+        if self.cache_size <= 0:
+            # No cache, distinct keys are queried in one call
+            distinct = list(dict.fromkeys(keys))
+            self.misses += len(distinct)
+            if len(distinct) == len(keys):
+                return self.db.count_many(keys)
+            found = dict(zip(distinct, self.db.count_many(distinct)))
+            return [found[key] for key in keys]
+
+        # Distinct keys missing from the cache are queried in one call
+        cache = self.cache
+        found = {}
+        missing = {}
+        for key in keys:
+            if key in cache:
+                cache.move_to_end(key)
+                found[key] = cache[key]
             else:
-                c_seq = c + seq[0:-1]
-            c_count = self.query(c_seq)
-            child.append((c_seq, c_count))
-            sum += c_count
-        threshold = max(sum * self.cutoff, self.n_cutoff)
+                missing[key] = None
+        self.hits += len(found)
+
+        if missing:
+            missing = list(missing)
+            self.misses += len(missing)
+            found.update(zip(missing, self.db.count_many(missing)))
+            for key in missing:
+                cache[key] = found[key]
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+        return [found[key] for key in keys]
+
+    def get_child(self, seq, forward=True):
+        childs = self.get_child_codes(Kmer.encode(seq), forward)
+        return Kmer.decode_many(childs, self.k)
+
+    def get_child_codes(self, code, forward=True):
+        c_codes = Kmer.children(code, self.k, forward)
+        if self.canonical:
+            # Reverse complements of the children are the children of the
+            # reverse complement on the other side, in the opposite order
+            (r3, r2, r1, r0) = Kmer.children(Kmer.revcomp(code, self.k),
+                                             self.k, not forward)
+            (c0, c1, c2, c3) = c_codes
+            keys = [min(c0, r0), min(c1, r1), min(c2, r2), min(c3, r3)]
+        else:
+            keys = c_codes
+        c_counts = self._counts(keys)
+        threshold = max(sum(c_counts) * self.cutoff, self.n_cutoff)
 
-        return [x[0] for x in [x for x in child if x[1] >= threshold]]
+        return [c for (c, n) in zip(c_codes, c_counts) if n >= threshold]
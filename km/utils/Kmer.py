@@ -0,0 +1,135 @@
+#                             -*- Mode: Python -*-
+# Kmer.py --- 2-bit encoding of k-mers in integers.
+#
+# Each base takes 2 bits (A=0, C=1, G=2, T=3), the first base in the highest
+# bits, so that codes sort as the k-mers do and k <= 32 fits in 64 bits.
+# The complement of a base is its code xor 3.
+#
+# Codes are Python ints, so any k can be encoded. Batches of k-mers use
+# numpy uint64 arrays for k <= MAX_K only, longer k-mers being handled one
+# by one (in numpy object arrays for batches).
+
+import numpy as np
+
+BASES = "ACGT"
+MAX_K = 32
+# Batch size under which a loop on single k-mers beats numpy's overhead
+SMALL_BATCH = 32
+
+_CODE = np.full(256, 255, dtype=np.uint8)
+for (_i, _c) in enumerate(BASES):
+    _CODE[ord(_c)] = _i
+    _CODE[ord(_c.lower())] = _i
+
+# Digits of each base in base 4, to encode single k-mers with int(..., 4)
+_DIGITS = str.maketrans("ACGTacgt", "01230123")
+# Shift and weight of each position of a k-mer of length MAX_K
+_SHIFTS = np.arange(2 * (MAX_K - 1), -1, -2, dtype=np.uint64)
+_WEIGHTS = np.uint64(1) << _SHIFTS
+# Bases of each byte of a code, and of each 2-bit value
+_BYTE_BASES = ["".join(BASES[(b >> s) & 3] for s in (6, 4, 2, 0))
+               for b in range(256)]
+_ASCII = np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)
+
+_COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+_MASK64 = (1 << 64) - 1
+_M2 = 0x3333333333333333
+_M4 = 0x0F0F0F0F0F0F0F0F
+
+
+def mask(k):
+    return (1 << (2 * k)) - 1
+
+
+def encode(seq):
+    """ Code of a k-mer given as a string. """
+    digits = seq.translate(_DIGITS)
+    if digits.strip("0123"):
+        raise ValueError("%s is not a DNA k-mer" % seq)
+    return int(digits, 4)
+
+
+def encode_many(seqs, k):
+    """ Codes of k-mers of length k, as a numpy uint64 array (an object
+    array of ints when k > MAX_K). """
+    if k > MAX_K:
+        return np.array([encode(s) for s in seqs], dtype=object)
+    if len(seqs) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    mat = _CODE[np.frombuffer("".join(seqs).encode("ascii"),
+                              dtype=np.uint8).reshape(len(seqs), k)]
+    if (mat == 255).any():
+        bad = [s for s in seqs if set(s.upper()) - set(BASES)][0]
+        raise ValueError("%s is not a DNA k-mer" % bad)
+
+    return mat.astype(np.uint64).dot(_WEIGHTS[MAX_K - k:])
+
+
+def decode(code, k):
+    """ String of the k-mer of length k given by code. """
+    nb_bytes = (k + 3) // 4
+    return "".join([_BYTE_BASES[b] for b in
+                    int(code).to_bytes(nb_bytes, "big")])[4 * nb_bytes - k:]
+
+
+def decode_many(codes, k):
+    """ Strings of the k-mers of length k given by codes, decoded on a
+    (n, k) byte matrix. """
+    if len(codes) < SMALL_BATCH or k > MAX_K:
+        return [decode(c, k) for c in codes]
+    codes = np.asarray(codes, dtype=np.uint64)
+    mat = _ASCII[(codes[:, None] >> _SHIFTS[MAX_K - k:]) & np.uint64(3)]
+    seqs = mat.tobytes().decode("ascii")
+    return [seqs[i:(i + k)] for i in range(0, len(seqs), k)]
+
+
+def last_base(code):
+    return BASES[code & 3]
+
+
+def revcomp(code, k):
+    """ Code of the reverse complement. """
+    if k > MAX_K:
+        return encode(decode(code, k).translate(_COMPLEMENT)[::-1])
+    x = ~code & _MASK64
+    # Reverse the order of the 2-bit bases: swap pairs, nibbles then bytes
+    x = ((x >> 2) & _M2) | ((x & _M2) << 2)
+    x = ((x >> 4) & _M4) | ((x & _M4) << 4)
+    x = int.from_bytes(x.to_bytes(8, "little"), "big")
+    return x >> (64 - 2 * k)
+
+
+def revcomp_many(codes, k):
+    if k > MAX_K:
+        return np.array([revcomp(int(c), k) for c in codes], dtype=object)
+    x = ~np.asarray(codes, dtype=np.uint64)
+    m2 = np.uint64(_M2)
+    m4 = np.uint64(_M4)
+    x = ((x >> np.uint64(2)) & m2) | ((x & m2) << np.uint64(2))
+    x = ((x >> np.uint64(4)) & m4) | ((x & m4) << np.uint64(4))
+    return x.byteswap() >> np.uint64(64 - 2 * k)
+
+
+def canonical(code, k):
+    """ Smallest of code and its reverse complement. """
+    return min(code, revcomp(code, k))
+
+
+def canonical_many(codes, k):
+    """ Smallest of each code and its reverse complement. """
+    if k > MAX_K:
+        return np.array([canonical(int(c), k) for c in codes], dtype=object)
+    codes = np.asarray(codes, dtype=np.uint64)
+    return np.minimum(codes, revcomp_many(codes, k))
+
+
+def children(code, k, forward=True):
+    """ Codes of the 4 k-mers following code (preceding if not forward),
+    the new base being A, C, G then T. """
+    if forward:
+        head = (code << 2) & mask(k)
+        return [head, head | 1, head | 2, head | 3]
+    tail = code >> 2
+    shift = 2 * (k - 1)
+    return [tail, tail | (1 << shift), tail | (2 << shift), tail | (3 << shift)]
@@ -0,0 +1,131 @@
+#                             -*- Mode: Python -*-
+# KmerArray.py --- k-mer counts kept in a sorted array of 2-bit codes.
+#
+# File layout (little endian):
+#   magic (8 bytes) | k (uint64) | n (uint64)
+#   n sorted k-mer codes (uint64) | n counts (uint32)
+# The arrays are memory-mapped and queried with a binary search.
+
+import numpy as np
+
+from . import Kmer
+
+MAGIC = b"KMARRAY1"
+_HEADER = np.dtype([("magic", "S8"), ("k", "<u8"), ("n", "<u8")])
+_MAX_COUNT = np.iinfo(np.uint32).max
+
+
+def is_kmer_array(filename):
+    """ Tells if filename is a k-mer array, from its magic header. """
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class KmerArray:
+
+    def __init__(self, k, codes, counts):
+        # codes must be sorted and distinct
+        self.k = k
+        self.codes = codes
+        self.counts = counts
+
+    @staticmethod
+    def from_counts(k, codes, counts):
+        """ Build an array from unsorted codes, counts of duplicated codes
+        being summed. """
+        if k > Kmer.MAX_K:
+            raise ValueError("k-mer arrays hold k-mers of at most %d bases, "
+                             "k=%d" % (Kmer.MAX_K, k))
+        codes = np.asarray(codes, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.uint64)
+        (uniq, inverse) = np.unique(codes, return_inverse=True)
+        summed = np.bincount(inverse, weights=counts, minlength=len(uniq))
+        summed = np.minimum(summed, _MAX_COUNT).astype(np.uint32)
+        return KmerArray(k, uniq, summed)
+
+    @staticmethod
+    def load(filename):
+        header = np.fromfile(filename, dtype=_HEADER, count=1)
+        if len(header) == 0 or header["magic"][0] != MAGIC:
+            raise ValueError("%s is not a k-mer array" % filename)
+        k = int(header["k"][0])
+        n = int(header["n"][0])
+        if n == 0:
+            return KmerArray(k, np.zeros(0, dtype=np.uint64),
+                             np.zeros(0, dtype=np.uint32))
+
+        codes = np.memmap(filename, dtype="<u8", mode="r",
+                          offset=_HEADER.itemsize, shape=(n,))
+        counts = np.memmap(filename, dtype="<u4", mode="r",
+                           offset=_HEADER.itemsize + 8 * n, shape=(n,))
+        return KmerArray(k, codes, counts)
+
+    def save(self, filename):
+        header = np.zeros(1, dtype=_HEADER)
+        header["magic"] = MAGIC
+        header["k"] = self.k
+        header["n"] = len(self.codes)
+        with open(filename, "wb") as f:
+            f.write(header.tobytes())
+            f.write(np.asarray(self.codes, dtype="<u8").tobytes())
+            f.write(np.asarray(self.counts, dtype="<u4").tobytes())
+
+    def __len__(self):
+        return len(self.codes)
+
+    def count_many(self, codes):
+        """ Counts of the given codes, 0 for absent k-mers. """
+        codes = np.asarray(codes, dtype=np.uint64)
+        if len(self.codes) == 0:
+            return [0] * len(codes)
+        idx = np.searchsorted(self.codes, codes)
+        idx[idx == len(self.codes)] = 0
+        found = self.codes[idx] == codes
+        return np.where(found, self.counts[idx], 0).tolist()
+
+
+def read_dump(lines, chunk_size=1000000):
+    """ Load the output of jellyfish dump, in fasta (">count" then k-mer)
+    or column ("k-mer count", dump -c) format. Returns a KmerArray. """
+    k = None
+    codes = []
+    counts = []
+    kmers = []
+    kcounts = []
+
+    def flush():
+        codes.append(Kmer.encode_many(kmers, k))
+        counts.append(np.array(kcounts, dtype=np.uint64))
+        del kmers[:]
+        del kcounts[:]
+
+    count = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '>':
+            count = int(line[1:])
+            continue
+        fields = line.split()
+        if len(fields) > 1:
+            count = int(fields[1])
+        elif count is None:
+            raise ValueError("No count given for k-mer %s" % fields[0])
+
+        if k is None:
+            k = len(fields[0])
+        kmers.append(fields[0])
+        kcounts.append(count)
+        count = None
+        if len(kmers) >= chunk_size:
+            flush()
+
+    if k is None:
+        raise ValueError("No k-mer found in dump")
+    flush()
+    return KmerArray.from_counts(k, np.concatenate(codes),
+                                 np.concatenate(counts))
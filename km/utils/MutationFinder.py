@@ -4,76 +4,169 @@
 
 import sys
 import logging as log
+import numpy as np
 
 from . import Graph as ug
+from . import Kmer
 from . import PathQuant as upq
 from .. utils import common as uc
 
 
-class MutationFinder:
-    def __init__(self, ref_name, ref_seq, jf, graphical, max_stack=500,
-                 max_break=10):
-        # Load the reference sequence and preparing ref k-mers
+def walk_neighbourhood(jf, ref_code, max_stack):
+    """ Query the counts of every k-mer a MutationFinder walk from ref_code
+    could need, with the cutoffs of jf and at most max_stack steps.
+
+    The search is breadth first and ignores the break limit, so that a
+    walk with higher cutoffs, less steps or any break limit only needs
+    k-mers queried here. Returns the set of reached k-mers.
+    """
+    seen = set(ref_code)
+    jf.query_codes(ref_code)
+    level = list(ref_code)
+    depth = 1
+    while level and depth <= max_stack:
+        next_level = []
+        for seq in level:
+            for child in jf.get_child_codes(seq, forward=True):
+                if child not in seen:
+                    seen.add(child)
+                    next_level.append(child)
+        level = next_level
+        depth += 1
+    return seen
 
-        self.first_seq = ref_seq[0:(jf.k)]
-        self.last_seq = ref_seq[-(jf.k):]
 
-        self.ref_mer = uc.get_ref_kmer(ref_seq, jf.k, ref_name)
-        self.ref_set = set(self.ref_mer)
+class MutationFinder:
+    def __init__(self, ref_name, ref_seq, jf, graphical, max_stack=500,
+                 max_break=10, compact=False, ref_mer=None, solver="gradient"):
+        # Load the reference sequence and preparing ref k-mers,
+        # unless they were already computed by the caller.
+        # K-mers are handled as 2-bit codes, decoded only for the output.
+
+        if ref_mer is None:
+            ref_mer = uc.get_ref_kmer(ref_seq, jf.k, ref_name)
+        self.ref_mer = ref_mer
+        self.ref_code = Kmer.encode_many(ref_mer, jf.k).tolist()
+        self.ref_set = set(self.ref_code)
         log.debug("Ref. set contains %d kmers.", len(self.ref_set))
 
+        self.first_seq = self.ref_code[0]
+        self.last_seq = self.ref_code[-1]
+
         self.ref_seq = ref_seq
         self.jf = jf
         self.node_data = {}
         self.done = set()
+        # k-mers whose walk failed: kmer -> (steps left, breaks left, len(done))
+        self.dead_end = {}
         self.ref_name = ref_name
 
+        (first_count, last_count) = self.jf.query_codes(
+            [self.first_seq, self.last_seq]).tolist()
         self.done.add(self.first_seq)
-        self.node_data[self.first_seq] = self.jf.query(self.first_seq)
+        self.node_data[self.first_seq] = first_count
         self.done.add(self.last_seq)
-        self.node_data[self.last_seq] = self.jf.query(self.last_seq)
+        self.node_data[self.last_seq] = last_count
 
         # in case there aren't any
         self.paths = []
 
         self.max_stack = max_stack
         self.max_break = max_break
+        self.compact = compact
+        self.solver = solver
 
-        # register all k-mers from the ref
-        for s in self.ref_set:
-            self.node_data[s] = self.jf.query(s)
+        # register all k-mers from the ref, in the order of the set of
+        # their strings which sets the node numbers
+        code_of = dict(zip(self.ref_mer, self.ref_code))
+        ref_list = [code_of[s] for s in set(self.ref_mer)]
+        ref_counts = self.jf.query_codes(ref_list).tolist()
+        for (s, c) in zip(ref_list, ref_counts):
+            self.node_data[s] = c
 
         # kmer walking from each k-mer of ref_seq
         self.done.update(self.ref_set)
-        for seq in self.ref_set:
+        for seq in ref_list:
             if seq == self.last_seq:
                 continue
-            self.__extend([seq], 0, 0)
+            self.__extend(seq)
 
         self.graph_analysis(graphical)
 
-    def __extend(self, stack, breaks, found):
-        """ Recursive depth first search """
-        if len(stack) > self.max_stack:
+    def __extend(self, seq):
+        """ Iterative depth first search starting from a reference k-mer.
+
+        The frame stack is the walked path itself, each frame being
+        [k-mer, breaks, budget, childs, next child, links found], so no
+        path is copied while going deeper.
+        """
+        frames = []
+        self.__push(frames, seq, 0)
+
+        while frames:
+            frame = frames[-1]
+            (cur_seq, breaks, budget, childs, i, found) = frame
+
+            if i < len(childs):
+                frame[4] += 1
+                child = childs[i]
+                if child in self.done:
+                    self.__connect(frames)
+                    self.done.add(child)
+                    frame[5] += 1
+                else:
+                    self.__push(frames, child, breaks)
+                continue
+
+            frames.pop()
+            if found == 0:
+                self.dead_end[cur_seq] = budget
+            elif frames:
+                frames[-1][5] += found
+
+    def __push(self, frames, seq, breaks):
+        """ Enter seq at the end of the walked path, unless the step or
+        break budget is exhausted or seq is a known dead end. """
+        depth = len(frames) + 1
+        if depth > self.max_stack:
             return
-        cur_seq = stack[-1]
-        childs = self.jf.get_child(cur_seq, forward=True)
+
+        # Remaining (steps, breaks) budget when leaving seq, along with
+        # the state of self.done: a walk from seq that found nothing
+        # can't find anything with a smaller budget until done grows.
+        budget = (self.max_stack - depth, self.max_break - breaks,
+                  len(self.done))
+        if seq in self.dead_end:
+            (steps_left, breaks_left, nb_done) = self.dead_end[seq]
+            if (budget[0] <= steps_left and budget[1] <= breaks_left and
+                    budget[2] == nb_done):
+                return
+
+        childs = self.jf.get_child_codes(seq, forward=True)
 
         if len(childs) > 1:
             breaks += 1
             if breaks > self.max_break:
+                self.dead_end[seq] = budget
                 return
 
-        for child in childs:
-            if child in self.done:
-                self.done.update(stack)
-                self.done.add(child)
-                for p in stack:
-                    self.node_data[p] = self.jf.query(p)
-                self.node_data[cur_seq] = self.jf.query(cur_seq)
-                found += 1
-            else:
-                self.__extend(stack + [child], breaks, found)
+        frames.append([seq, breaks, budget, childs, 0, 0])
+
+    def __connect(self, frames):
+        """ Register the walked path, which links back to the graph. """
+        # Explored k-mers always form a prefix of the path, since a path
+        # is registered as a whole: only its unexplored tail is new.
+        new_seqs = []
+        for frame in reversed(frames):
+            if frame[0] in self.done:
+                break
+            new_seqs.append(frame[0])
+        new_seqs.reverse()
+
+        self.done.update(new_seqs)
+        counts = self.jf.query_codes(new_seqs).tolist()
+        for (p, c) in zip(new_seqs, counts):
+            self.node_data[p] = c
 
     def graph_analysis(self, graphical=False):
         self.paths = []
@@ -81,46 +174,74 @@ class MutationFinder:
 
         num_k = len(kmer)
         graph = ug.Graph(num_k)
+        kmer_index = {k: i for (i, k) in enumerate(kmer)}
         # The reference path, with node numbers
-        ref_index = [kmer.index(k) for k in self.ref_mer]
+        ref_index = [kmer_index[k] for k in self.ref_code]
 
         log.debug("k-mer graph contains %d nodes.", num_k)
 
+        # Nodes sharing each (k-1)-prefix, an edge links i to every node
+        # whose prefix is the suffix of i
+        suffix_mask = Kmer.mask(self.jf.k - 1)
+        prefix_index = {}
+        for (j, k) in enumerate(kmer):
+            prefix_index.setdefault(k >> 2, []).append(j)
+
         for i in range(num_k):
-            for j in range(num_k):
+            for j in prefix_index.get(kmer[i] & suffix_mask, []):
                 if i == j:
                     continue
-                if kmer[i][1:] == kmer[j][:-1]:
-                    weight = 1
-                    graph[i, j] = weight
+                weight = 1
+                graph[i, j] = weight
 
         for k in range(len(ref_index)-1):
             i = ref_index[k]
             j = ref_index[k+1]
             graph[i, j] = 0.01
 
-        graph.init_paths(kmer.index(self.first_seq),
-                         kmer.index(self.last_seq))
-        short_paths = graph.all_shortest()
+        first = kmer_index[self.first_seq]
+        last = kmer_index[self.last_seq]
+        if self.compact:
+            # Search paths on unitigs, expanded back to k-mer nodes. Ties
+            # between equal cost paths may be broken differently.
+            unitig_graph = graph.compact(protected=[first, last])
+            unitig_graph.init_paths(unitig_graph.unitig_of[first],
+                                    unitig_graph.unitig_of[last])
+            short_paths = [unitig_graph.expand(path)
+                           for path in unitig_graph.all_shortest()]
+        else:
+            graph.init_paths(first, last)
+            short_paths = graph.all_shortest()
+
+        # Annotations of the paths (diff with the reference, name, sequence)
+        # are computed once, and shared by the individual and cluster outputs
+        last_base = [Kmer.last_base(code) for code in kmer]
+        node_count = np.array(list(self.node_data.values()), dtype=np.int64)
+        full_seqs = {}
 
         def get_seq(path, kmer, skip_prefix=True):
-            path = list(path)
-            if not path:
+            if len(path) == 0:
                 # Deals with an empty sequence
                 return ""
 
             if skip_prefix:
-                seq = kmer[path[0]][-1]
-            else:
-                seq = kmer[path[0]]
+                return "".join([last_base[i] for i in path])
 
-            for i in path[1:]:
-                seq += kmer[i][-1]
-            return seq
+            path = tuple(path)
+            if path not in full_seqs:
+                full_seqs[path] = (Kmer.decode(kmer[path[0]], self.jf.k) +
+                                   "".join([last_base[i] for i in path[1:]]))
+            return full_seqs[path]
 
-        def get_name(a, b, offset=0):
+        # Diff of each path with the reference
+        variant_diffs = [graph.diff_path_without_overlap(ref_index, variant,
+                                                         self.jf.k)
+                         for variant in short_paths]
+
+        def get_name(a, b, offset=0, diff=None):
             k = self.jf.k
-            diff = graph.diff_path_without_overlap(a, b, k)
+            if diff is None:
+                diff = graph.diff_path_without_overlap(a, b, k)
             deletion = diff[3]
             ins = diff[4]
 
@@ -175,23 +296,36 @@ class MutationFinder:
                     diff[1] + 1 + offset)
 
         def get_counts(path, kmer):
-            counts = []
-            for i in path:
-                counts += [self.node_data[kmer[i]]]
-            # print("length counts: " + str(len(counts)))
-            # print("min counts: " + str(min(counts)))
+            return node_count[list(path)].tolist()
+
+        def get_min(path):
+            return node_count[list(path)].min()
+
+        counts = node_count.astype(np.float32)
 
-            return counts
+        names = [get_name(ref_index, path, diff=diff)
+                 for (path, diff) in zip(short_paths, variant_diffs)]
 
         # Quantify all paths independently
         individual = True
         if individual:
-            for path in short_paths:
+            # With NNLS, all the fits against the reference are solved at once
+            if self.solver == "nnls" and short_paths:
+                coefs = upq.quant_vs_ref(short_paths, ref_index, counts)
+            else:
+                coefs = [None] * len(short_paths)
+
+            for (path, coef, name) in zip(short_paths, coefs, names):
+                if coef is not None:
+                    coef = coef.reshape(2, 1)
                 quant = upq.PathQuant(all_path=[path, ref_index],
-                                      counts=list(self.node_data.values()))
+                                      counts=counts,
+                                      solver=self.solver,
+                                      coef=coef)
 
-                quant.compute_coef()
-                quant.refine_coef()
+                if coef is None:
+                    quant.compute_coef()
+                    quant.refine_coef()
                 quant.get_ratio()
 
                 # Reference
@@ -201,10 +335,10 @@ class MutationFinder:
                 self.paths_quant = quant.get_paths(
                     db_f=self.jf.filename,
                     ref_name=self.ref_name,
-                    name_f=lambda path: get_name(ref_index, path),
+                    name_f=lambda path: name,
                     seq_f=lambda path: get_seq(path, kmer, skip_prefix=False),
                     ref_path=ref_index, info="vs_ref",
-                    get_min_f=lambda path: min(get_counts(path, kmer)))
+                    get_min_f=get_min)
 
                 self.paths += self.paths_quant
 
@@ -212,9 +346,9 @@ class MutationFinder:
                 import matplotlib.pyplot as plt
 
                 plt.figure(figsize=(10, 6))
-                for path in short_paths:
+                for (path, name) in zip(short_paths, names):
                     plt.plot(get_counts(path, kmer),
-                             label=get_name(ref_index, path).replace("\t", " "))
+                             label=name.replace("\t", " "))
                 plt.legend()
                 plt.show()
 
@@ -222,34 +356,24 @@ class MutationFinder:
         # considering overlapping mutations as a cluster
         cluster = True
         if cluster:
-            variant_diffs = []
-            variant_set = set(range(0, len(short_paths)))
-            for variant in short_paths:
-                diff = graph.diff_path_without_overlap(
-                    ref_index, variant, self.jf.k)
-                variant_diffs += [diff]
-
-            def get_intersect(start, stop):
-                for var in variant_set:
-                    if (variant_diffs[var][1] >= start and
-                            variant_diffs[var][0] <= stop):
-                        return var
-                return -1
-
+            # Sweep the (start, stop) diff intervals by start: a variant
+            # joins the current group when it starts before the group stops
+            by_start = sorted(range(len(short_paths)),
+                              key=lambda var: variant_diffs[var][0])
             variant_groups = []
-            while len(variant_set) > 0:
-                seed = variant_set.pop()
-                grp = [seed]
-                start = variant_diffs[seed][0]
-                stop = variant_diffs[seed][1]
-                variant = get_intersect(start, stop)
-                while variant != -1:
-                    variant_set.remove(variant)
-                    grp += [variant]
-                    start = min(start, variant_diffs[variant][0])
-                    stop = max(stop, variant_diffs[variant][1])
-                    variant = get_intersect(start, stop)
-                variant_groups += [(start, stop, grp)]
+            for var in by_start:
+                (start, stop) = variant_diffs[var][0:2]
+                if variant_groups and start <= variant_groups[-1][1]:
+                    grp = variant_groups[-1]
+                    grp[1] = max(grp[1], stop)
+                    grp[2].append(var)
+                else:
+                    variant_groups.append([start, stop, [var]])
+
+            # Groups in the order of their first variant
+            for grp in variant_groups:
+                grp[2].sort()
+            variant_groups.sort(key=lambda grp: grp[2][0])
 
             num_cluster = 0
             for var_gr in variant_groups:
@@ -264,13 +388,20 @@ class MutationFinder:
                 offset = max(0, start - var_size)
                 ref_path = ref_index[offset:stop]
                 clipped_paths = [ref_path]
+                # A clipped path differs from the clipped reference as the
+                # full path from the reference, shifted by offset: the names
+                # of the full paths are kept
+                clipped_names = {}
                 for var in var_gr[2]:
                     start_off = offset
                     stop_off = variant_diffs[var][2] + (stop - variant_diffs[var][1])
                     clipped_paths += [short_paths[var][start_off:stop_off]]
+                    clipped_names[tuple(clipped_paths[-1])] = names[var]
+                clipped_names[tuple(ref_path)] = "Reference\t"
 
                 quant = upq.PathQuant(all_path=clipped_paths,
-                                      counts=list(self.node_data.values()))
+                                      counts=counts,
+                                      solver=self.solver)
 
                 quant.compute_coef()
                 quant.refine_coef()
@@ -280,11 +411,11 @@ class MutationFinder:
                 self.paths_quant = quant.get_paths(
                     db_f=self.jf.filename,
                     ref_name=self.ref_name,
-                    name_f=lambda path: get_name(ref_path, path, offset),
+                    name_f=lambda path: clipped_names[tuple(path)],
                     seq_f=lambda path: get_seq(path, kmer, skip_prefix=False),
                     ref_path=ref_path,
                     info="cluster %d n=%d" % (num_cluster, len(var_gr[2])),
-                    get_min_f=lambda path: min(get_counts(path, kmer)),
+                    get_min_f=get_min,
                     start_off=start_off)
 
                 self.paths_quant
@@ -301,13 +432,13 @@ class MutationFinder:
                                      label="Reference")
                         else:
                             plt.plot(get_counts(path, kmer),
-                                     label=get_name(ref_path, path, offset).split("\t")[0])
+                                     label=clipped_names[tuple(path)].split("\t")[0])
                     plt.legend()
                     plt.show()
 
     def get_paths(self, sort=True):
         if sort:
-            self.paths = sorted(self.paths, key=lambda x: (x[3], x[2], x[6]))
+            self.paths = sorted(self.paths, key=lambda x: x.sort_key)
         return self.paths
 
     def get_paths_quant(self):
@@ -5,44 +5,172 @@
 import numpy as np
 import logging as log
 
+# Columns of the find_mutation output, one line per quantified path
+HEADER = ("Database\tQuery\tType\tVariant_name\tRatio\tExpression\t"
+          "Min_coverage\tStart_offset\tSequence\tReference_ratio\t"
+          "Reference_expression\tReference_sequence\tInfo")
+
+
+def nnls(a, b, max_iter=None):
+    """ Non-negative least squares, min ||a x - b|| with x >= 0, by the
+    active set method of Lawson and Hanson.
+
+    Returns (x, number of iterations).
+    """
+    (m, n) = a.shape
+    if max_iter is None:
+        max_iter = 3 * n
+    tol = 10 * np.finfo(float).eps * max(m, n) * max(np.abs(a).sum(axis=0).max(), 1)
+
+    def solve(passive):
+        z = np.zeros(n)
+        z[passive] = np.linalg.lstsq(a[:, passive], b, rcond=None)[0]
+        return z
+
+    x = np.zeros(n)
+    passive = np.zeros(n, dtype=bool)
+    w = a.T.dot(b)
+    num_iter = 0
+
+    while num_iter < max_iter:
+        free = ~passive & (w > tol)
+        if not free.any():
+            break
+        j = np.argmax(np.where(free, w, -np.inf))
+        passive[j] = True
+        num_iter += 1
+        z = solve(passive)
+        if z[j] <= tol:
+            # Degenerate column (e.g. a copy of a used one), no better fit
+            passive[j] = False
+            w[j] = 0
+            continue
+
+        while passive.any() and z[passive].min() <= tol:
+            # Step back to the last feasible point, and free the
+            # coefficients hitting zero
+            neg = passive & (z <= tol)
+            alpha = np.min(x[neg] / (x[neg] - z[neg]))
+            x += alpha * (z - x)
+            passive &= x > tol
+            x[~passive] = 0
+            num_iter += 1
+            z = solve(passive)
+
+        x = z
+        w = a.T.dot(b - a.dot(x))
+
+    return (x, num_iter)
+
+
+def quant_vs_ref(all_path, ref_path, counts):
+    """ Coefficients of each path fitted along with the reference path: the
+    non-negative least squares fit of counts on the 2 columns [path,
+    ref_path], for all paths at once. Returns an array of shape
+    (len(all_path), 2).
+
+    Each fit is solved from its 2x2 normal equations. When the unconstrained
+    solution has a non positive coefficient, or when the path has the same
+    k-mers as the reference, the best fit on a single column is kept, as
+    the active set method would.
+    """
+    counts = np.asarray(counts, dtype=float)
+    n = len(counts)
+    nb_path = len(all_path)
+
+    ref = np.bincount(np.asarray(ref_path, dtype=np.intp), minlength=n)
+    rr = float(ref.dot(ref))
+    rb = ref.dot(counts)
+
+    # Multiplicity of each k-mer in each path, from flat index arrays
+    path_i = np.repeat(np.arange(nb_path), [len(p) for p in all_path])
+    nodes = np.concatenate([np.asarray(p, dtype=np.intp) for p in all_path])
+    (pairs, mult) = np.unique(path_i * n + nodes, return_counts=True)
+    (pair_path, pair_node) = np.divmod(pairs, n)
+
+    pp = np.bincount(pair_path, weights=mult ** 2, minlength=nb_path)
+    pr = np.bincount(pair_path, weights=mult * ref[pair_node], minlength=nb_path)
+    pb = np.bincount(pair_path, weights=mult * counts[pair_node], minlength=nb_path)
+
+    coef = np.zeros((nb_path, 2))
+
+    # Single column fits, the one reducing most the squared residual is kept
+    fit_p = np.maximum(pb, 0) / np.maximum(pp, 1)
+    fit_r = max(rb, 0) / max(rr, 1)
+    use_r = rb * fit_r > pb * fit_p
+    coef[:, 0] = np.where(use_r, 0, fit_p)
+    coef[:, 1] = np.where(use_r, fit_r, 0)
+
+    # Both columns, when they are independent and both coefficients positive
+    det = pp * rr - pr ** 2
+    full = det > 1e-9 * pp * rr
+    det[~full] = 1
+    x_p = (rr * pb - pr * rb) / det
+    x_r = (pp * rb - pr * pb) / det
+    both = full & (x_p > 0) & (x_r > 0)
+    coef[both, 0] = x_p[both]
+    coef[both, 1] = x_r[both]
+
+    return coef
+
 
 class Path:
+    """ One output line: a path quantified against the reference. """
+
+    # Output fields, with their format
+    fields = (("db_name", "%s"),
+              ("ref_name", "%s"),
+              ("variant_type", "%s"),
+              ("variant_name", "%s"),
+              ("ratio", "%.3f"),
+              ("expression", "%.1f"),
+              ("min_coverage", "%d"),
+              ("start_off", "%d"),
+              ("sequence", "%s"),
+              ("ref_ratio", "%.3f"),
+              ("ref_expression", "%.1f"),
+              ("ref_sequence", "%s"),
+              ("note", "%s"))
+    line_format = "\t".join(f for (name, f) in fields)
+
+    __slots__ = tuple(name for (name, f) in fields) + ("sort_key",)
+
     def __init__(self, db_f, ref_name, variant_name, ratio, expression,
                  min_coverage, start_off, sequence, ref_ratio, ref_expression,
                  ref_sequence, note):
+        # variant_name is "type\tname"
+        (variant_type, variant_name) = variant_name.split("\t", 1)
+
         self.db_name = db_f
         self.ref_name = ref_name
+        self.variant_type = variant_type
         self.variant_name = variant_name
-        self.ratio = ratio
-        self.expression = expression
-        self.min_coverage = min_coverage
-        self.start_off = start_off
+        self.ratio = _scalar(ratio)
+        self.expression = _scalar(expression)
+        self.min_coverage = int(min_coverage)
+        self.start_off = int(start_off)
         self.sequence = sequence
-        self.ref_ratio = ref_ratio
-        self.ref_expression = ref_expression
+        self.ref_ratio = _scalar(ref_ratio)
+        self.ref_expression = _scalar(ref_expression)
         self.ref_sequence = ref_sequence
         self.note = note
 
+        # Output order: variant name, type then min coverage, which is
+        # ordered as its printed value
+        self.sort_key = (variant_name, variant_type, "%d" % self.min_coverage)
+
+    def values(self):
+        return tuple(getattr(self, name) for (name, f) in Path.fields)
+
     def __str__(self):
-        return "%s\t%s\t%s\t%.3f\t%.1f\t%d\t%d\t%s\t%.3f\t%.1f\t%s\t%s" % (
-            self.db_name,
-            self.ref_name,
-            self.variant_name,
-            self.ratio,
-            self.expression,
-            self.min_coverage,
-            self.start_off,
-            self.sequence,
-            self.ref_ratio,
-            self.ref_expression,
-            self.ref_sequence,
-            self.note)
+        return Path.line_format % self.values()
 
     def __list__(self):
-        return self.__str__().split('\t')
-    
+        return [f % getattr(self, name) for (name, f) in Path.fields]
+
     def __getitem__(self, i):
-        return self.__list__()[i]
+        (name, f) = Path.fields[i]
+        return f % getattr(self, name)
 
     @staticmethod
     def get_min_cov(self):
@@ -52,30 +180,50 @@ class Path:
         return self.sequence
 
     def get_variant_name(self):
-        return self.variant_name
+        return self.variant_type + "\t" + self.variant_name
+
+
+def _scalar(x):
+    # Coefficients come as 1-element arrays
+    return np.asarray(x, dtype=float).item()
 
 
 class PathQuant:
-    def __init__(self, all_path, counts):
+    # Available solvers for the non-negative coefficients
+    solvers = ("nnls", "gradient")
+
+    def __init__(self, all_path, counts, solver="gradient", coef=None):
+        if solver not in PathQuant.solvers:
+            raise ValueError("Unknown solver %s" % solver)
+        self.solver = solver
         self.all_path = all_path
+        # counts has one count per k-mer of the graph. Only the rows of the
+        # k-mers used by a path are kept, but the gradient is still scaled
+        # by the number of k-mers of the graph, and the gradient descent
+        # keeps the float rounding of a fit on all the rows.
+        counts = np.asarray(counts, dtype=np.float32)
         self.nb_kmer = len(counts)
         self.nb_seq = len(all_path)
+        self.min_count = counts.min()
 
-        self.contrib = np.zeros((self.nb_kmer, self.nb_seq), dtype=np.int32)
-        self.counts = np.zeros((self.nb_kmer, 1), dtype=np.float32)
-
-        self.coef = None
+        self.coef = coef
         self.ratio = None
+        self.num_iter = 0
+        if coef is not None:
+            # Coefficients already solved, e.g. by quant_vs_ref
+            return
 
-        seq_i = 0
-        log.debug("%d sequence(s) are observed.", self.nb_seq)
+        nodes = [np.asarray(s, dtype=np.intp) for s in all_path]
+        path_i = np.repeat(np.arange(self.nb_seq), [len(s) for s in nodes])
+        (used, rows) = np.unique(np.concatenate(nodes), return_inverse=True)
 
-        for s in all_path:
-            for i in s:
-                self.contrib[i, seq_i] += 1
-            seq_i += 1
+        self.contrib = np.zeros((len(used), self.nb_seq), dtype=np.int32)
+        np.add.at(self.contrib, (rows, path_i), 1)
+        self.counts = counts[used].reshape(len(used), 1)
+        self.used = used
+        self.all_counts = counts.reshape(self.nb_kmer, 1)
 
-        self.counts[:, 0] = counts
+        log.debug("%d sequence(s) are observed.", self.nb_seq)
 
     def compute_coef(self):
         # Set coefficient to zero if all paths use a kmer with 0 coverage
@@ -84,24 +232,44 @@ class PathQuant:
         #     if min(c) == 1 and d == 0:
         #         self.coef = np.zeros((len(c), 1), dtype=np.float32)
         #         return
-        (coef, residual, rank, s) = np.linalg.lstsq(self.contrib, self.counts, rcond=None)
+        if self.solver == "nnls":
+            (coef, self.num_iter) = nnls(self.contrib.astype(float),
+                                         self.counts[:, 0].astype(float))
+            self.coef = coef.reshape(self.nb_seq, 1)
+            log.debug("NNLS fitting = %s, %d iterations",
+                      self.coef.flatten(), self.num_iter)
+            return
+
+        # Solved on the rows of all the k-mers: the zero rows of the unused
+        # ones don't change the fit, but change its rounding
+        contrib = np.zeros((self.nb_kmer, self.nb_seq), dtype=np.int32)
+        contrib[self.used] = self.contrib
+        (coef, residual, rank, s) = np.linalg.lstsq(contrib, self.all_counts, rcond=None)
         self.coef = coef
         log.debug("Linear fitting = %s", self.coef.flatten())
 
     def refine_coef(self):
+        # NNLS coefficients are already non negative
+        if self.solver == "nnls":
+            return
         # if max(self.coef) == 0: return
         # applies a gradient descent to get rid of negative coefficients
         self.coef[self.coef < 0] = 0
         last_max_grad = np.inf
         num_iter = 0
+        # Terms of the gradient, on the used rows. They are summed along
+        # with zeros for the other k-mers, in the order of the whole graph,
+        # as the rounding of the sum depends on it.
+        terms = np.zeros((self.nb_kmer, 1))
 
         # convergence threshold
         while last_max_grad > 0.01:
             grad = np.zeros_like(self.coef, dtype=np.float32)
             counts_hat = np.dot(self.contrib, self.coef)
             for j in range(self.nb_seq):
-                grad[j, 0] = np.sum(2 * (self.counts - counts_hat) *
+                terms[self.used] = (2 * (self.counts - counts_hat) *
                                     self.contrib[:, j].reshape(counts_hat.shape))
+                grad[j, 0] = np.sum(terms)
             grad /= self.nb_kmer
             self.coef += 0.1 * grad
             grad[self.coef < 0] = 0
@@ -111,6 +279,7 @@ class PathQuant:
             log.debug("Iteration = %d, max_gradient = %f",
                       num_iter,
                       last_max_grad)
+        self.num_iter = num_iter
         log.debug("Refined fitting = %s", self.coef.flatten())
 
     def get_ratio(self):
@@ -121,17 +290,17 @@ class PathQuant:
         return self.ratio
 
     def adjust_for_reference(self):
-        if min(self.counts) == 0:
+        if self.min_count == 0:
             self.ratio[0] = 0
             self.ratio[1] = 0
         else:
             self.ratio[0] = 1
             self.ratio[1] = 1
-        self.coef[self.coef >= 0] = min(self.counts)[0]
+        self.coef[self.coef >= 0] = self.min_count
 
     @staticmethod
     def output_header():
-        print("Database\tQuery\tType\tVariant_name\tRatio\tExpression\tMin_coverage\tStart_offset\tSequence\tReference_ratio\tReference_expression\tReference_sequence\tInfo")
+        print(HEADER)
 
     def output(self, db_f, ref_name, name_f, seq_f):
         for i in range(self.nb_seq):
@@ -20,6 +20,20 @@ def target_2_seqfiles(target_fn):
     return(args_2_list_files(target_fn))
 
 
+def jellyfish_2_dbfiles(jellyfish_fn, db_list=False):
+    """Gather file names for jellyfish databases, from a list file if db_list."""
+    if not db_list:
+        return([jellyfish_fn])
+
+    lst_files = []
+    for line in open(jellyfish_fn, "r"):
+        line = line.strip()
+        if len(line) > 0 and line[0] != '#':
+            lst_files.append(line)
+
+    return(lst_files)
+
+
 def file_2_seq(seq_f):
     ref_seq = []
     for line in open(seq_f, "r"):
@@ -56,22 +70,12 @@ def mean(v):
 
 
 def get_cov(db, ref_seq):
-    jf = Jellyfish(db)
-    cnt_stack = []
-
-    i = 0
-    count = 0
-    cpt_count_0 = 0
-    while i <= (len(ref_seq) - jf.k):
-        kmer = ref_seq[i:i+jf.k]
-        cnt = jf.query(kmer)
-        cnt_stack += [int(cnt)]
-        count += int(cnt)
-        if int(cnt) == 0:
-            cpt_count_0 += 1
-
-        # print kmer, cnt
-        i += 1
+    """ Coverage of ref_seq in db, a database filename or opened Jellyfish. """
+    jf = db if isinstance(db, Jellyfish) else Jellyfish(db)
+    kmers = [ref_seq[i:i+jf.k] for i in range(len(ref_seq) - jf.k + 1)]
+    cnt_stack = jf.query_many(kmers).tolist()
+    count = sum(cnt_stack)
+    cpt_count_0 = cnt_stack.count(0)
 
     return(count, len(ref_seq), min(cnt_stack), max(cnt_stack),
            mean(cnt_stack), len(cnt_stack), cpt_count_0)